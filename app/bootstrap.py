@@ -6,6 +6,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from db.setup import init_db, SessionLocal
 from model.db import Base, User, House, Room, Lamp, CeilingLight, Blinds, Lock, Alarm, HouseUserRole
+from server.auth import hash_password
 
 def seed():
     """Create a demo environment with multiple users, houses, and devices."""
@@ -16,9 +17,9 @@ def seed():
         print("[SEED] Starting database seeding for smart home demo...")
         
         # Create multiple users with different roles
-        user1 = User(username="user1", password_hash="password1")
-        user2 = User(username="user2", password_hash="password2")
-        user3 = User(username="user3", password_hash="password3")
+        user1 = User(username="user1", password_hash=hash_password("password1"))
+        user2 = User(username="user2", password_hash=hash_password("password2"))
+        user3 = User(username="user3", password_hash=hash_password("password3"))
         
         session.add_all([user1, user2, user3])
         session.flush()
@@ -36,6 +36,13 @@ def message_listener(ws):
             message = ws.recv()
             data = json.loads(message)
             
+            # Device updates that arrive close together are batched by the server
+            if data.get("type") == "batch_update":
+                for event in data.get("events", []):
+                    broadcast_queue.put(event)
+                    handle_broadcast_message(event)
+                continue
+            
             # Determine if this is a broadcast or a response
             if "type" in data and data["type"] in ["room_added", "device_added", "room_removed", "device_removed",
                                                   "lamp_update", "ceiling_light_update", "lock_update", 
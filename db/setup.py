@@ -1,5 +1,6 @@
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from model.db import Base
 
 # Change this URL to your actual database configuration
@@ -10,12 +11,14 @@ DATABASE_URL = "sqlite:///smart_home.db"
 engine = create_engine(
     DATABASE_URL,
     connect_args={"check_same_thread": False},  # Allow SQLite to be used from multiple threads
-    echo=True,
+    echo=False,  # SQL logging formats and writes every statement; turn on only for debugging
     # Add connection pooling parameters
-    pool_size=5,
-    max_overflow=10,
+    poolclass=QueuePool,
+    pool_size=25,
+    max_overflow=25,
     pool_timeout=30,
-    pool_recycle=1800  # Recycle connections after 30 minutes
+    pool_recycle=1800,  # Recycle connections after 30 minutes
+    pool_pre_ping=True  # Replace dead pooled connections instead of failing the request
 )
 
 # Configure SQLite for better concurrent access
@@ -26,8 +29,9 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.execute("PRAGMA synchronous=NORMAL")  # Slightly faster at minimal risk
     cursor.close()
 
-# Scoped session for thread-safe use
-SessionLocal = scoped_session(sessionmaker(bind=engine))
+# Scoped session for thread-safe use; each handler thread reuses its own session
+# and objects stay readable after commit so handlers don't trigger a reload
+SessionLocal = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
 
 # Call this once at application startup to ensure all tables exist
 def init_db():
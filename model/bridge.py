@@ -3,6 +3,7 @@
 from model.domain import User, SmartHouse, Room, Lamp, Lock, Blinds, CeilingLight, Alarm
 from model.db import User as UserORM, House as HouseORM, Room as RoomORM, Lamp as LampORM, Lock as LockORM
 from model.db import Blinds as BlindsORM, CeilingLight as CeilingLightORM, Alarm as AlarmORM
+from sqlalchemy.orm import selectinload
 
 
 # Translate ORM user + role into domain user
@@ -96,6 +97,16 @@ def domain_alarm_from_orm(alarm_row):
     return alarm
 
 
+# Loader options for everything domain_house_from_orm reads, so a house loads in one
+# SELECT per relationship instead of lazy loads for every room
+HOUSE_LOAD_OPTIONS = (
+    selectinload(HouseORM.rooms).selectinload(RoomORM.lamps),
+    selectinload(HouseORM.rooms).selectinload(RoomORM.locks),
+    selectinload(HouseORM.rooms).selectinload(RoomORM.ceiling_light),
+    selectinload(HouseORM.rooms).selectinload(RoomORM.blinds),
+    selectinload(HouseORM.alarm),
+)
+
 def domain_house_from_orm(house_row):
     house = SmartHouse(house_id=house_row.id, name=house_row.name)
     
@@ -150,4 +161,47 @@ def update_orm_ceiling_light_from_domain(cl_domain: CeilingLight, cl_orm: Ceilin
 
 def update_orm_alarm_from_domain(alarm_domain: Alarm, alarm_orm: AlarmORM):
     alarm_orm.is_armed = alarm_domain.is_armed
-    alarm_orm.is_alarm = alarm_domain.is_alarm
\ No newline at end of file
+    alarm_orm.is_alarm = alarm_domain.is_alarm
+# Plain column mappings of domain state, for bulk updates keyed by primary key
+def lamp_to_mapping(lamp_domain: Lamp, room_id):
+    return {
+        "id": lamp_domain.device_id,
+        "room_id": room_id,
+        "on": lamp_domain.on,
+        "shade": lamp_domain.shade,
+        "color": lamp_domain.color,
+    }
+
+def lock_to_mapping(lock_domain: Lock, room_id):
+    return {
+        "id": lock_domain.device_id,
+        "room_id": room_id,
+        "is_unlocked": lock_domain.is_unlocked,
+        "failed_attempts": lock_domain.failed_attempts,
+        "code": ",".join(lock_domain._code),  # re-encode list as CSV string
+    }
+
+def blinds_to_mapping(blinds_domain: Blinds, room_id):
+    return {
+        "id": blinds_domain.device_id,
+        "room_id": room_id,
+        "is_up": blinds_domain.is_up,
+        "is_open": blinds_domain.is_open,
+    }
+
+def ceiling_light_to_mapping(cl_domain: CeilingLight, room_id):
+    return {
+        "id": cl_domain.device_id,
+        "room_id": room_id,
+        "on": cl_domain.on,
+        "shade": cl_domain.shade,
+        "color": cl_domain.color,
+    }
+
+def alarm_to_mapping(alarm_domain: Alarm, room_id=None):
+    # The alarm belongs to the house, so its primary key is just the id
+    return {
+        "id": alarm_domain.device_id,
+        "is_armed": alarm_domain.is_armed,
+        "is_alarm": alarm_domain.is_alarm,
+    }
@@ -7,6 +7,11 @@ Created on April 25, 2025
 
 '''
 
+import itertools
+
+# Source of room state versions; next() on a count is atomic, so concurrent touches never collide
+_state_versions = itertools.count(1)
+
 class User:
     def __init__(self, user_id: int, username: str, role: str = "guest"):
         self.user_id = user_id
@@ -32,7 +37,14 @@ class Room:
         self.ceiling_light = None  # only one
         self.blinds = None         # only one
         self.device_map = {}
+        self.devices_by_type = {}  # dict: device_type → {device_id → device}
         self.next_device_id = 1    # Track next device ID for this room
+        self.state_version = next(_state_versions)  # changes whenever a device in the room changes
+        self.state_cache = None    # (state_version, snapshot) kept by the server
+
+    def touch(self):
+        """Mark the room's devices as changed so cached snapshots are rebuilt."""
+        self.state_version = next(_state_versions)
 
     def get_next_device_id(self):
         device_id = self.next_device_id
@@ -48,6 +60,13 @@ class Room:
             self.device_map[self.ceiling_light.device_id] = self.ceiling_light
         if self.blinds:
             self.device_map[self.blinds.device_id] = self.blinds
+        self.devices_by_type = {}
+        for device_id, device in self.device_map.items():
+            self.devices_by_type.setdefault(device.device_type, {})[device_id] = device
+        self.touch()
+        # keep the house-wide index in step with this room
+        if getattr(self, "house", None) is not None:
+            self.house.index_room(self)
 
     def set_house(self, house):
         self.house = house
@@ -74,6 +93,43 @@ class Room:
             raise ValueError("Ceiling light already exists.")
         self.ceiling_light = ceiling_light
 
+    # device_type → the add_* method that stores that kind of device
+    _ADDERS = {
+        "Lamp": "add_lamp",
+        "Lock": "add_lock",
+        "Blinds": "add_blinds",
+        "CeilingLight": "add_ceiling_light",
+    }
+
+    def add_device(self, device):
+        """Add a device of any room-level type and index it in place."""
+        getattr(self, self._ADDERS[device.device_type])(device)
+        self.device_map[device.device_id] = device
+        self.devices_by_type.setdefault(device.device_type, {})[device.device_id] = device
+        self.touch()
+        if getattr(self, "house", None) is not None:
+            self.house.index_device(self.room_id, device)
+
+    def remove_device(self, device_id):
+        """Remove a device by id and drop it from the caches; returns it, or None if missing."""
+        device = self.device_map.pop(device_id, None)
+        if device is None:
+            return None
+        device_type = device.device_type
+        self.devices_by_type.get(device_type, {}).pop(device_id, None)
+        if device_type == "Lamp":
+            del self.lamps[device_id]
+        elif device_type == "Lock":
+            del self.locks[device_id]
+        elif device_type == "CeilingLight":
+            self.ceiling_light = None
+        elif device_type == "Blinds":
+            self.blinds = None
+        self.touch()
+        if getattr(self, "house", None) is not None:
+            self.house.unindex_device(self.room_id, device_id)
+        return device
+
     def check_status(self):
         """Returns the current status of the room with all devices using device_map."""
         status = {
@@ -85,7 +141,7 @@ class Room:
         
         # Use device_map to get devices by type
         for device_id, device in self.device_map.items():
-            device_type = type(device).__name__
+            device_type = device.device_type
             if device_type == "Lamp":
                 status["lamps"][device_id] = device.check_status()
             elif device_type == "Lock":
@@ -106,6 +162,9 @@ class SmartHouse:
         self.rooms = {}
         self.alarm = None
         self.next_device_id = 1
+        self.devices_by_id = {}  # dict: (room_id, device_id) → (device, type name)
+        self.structure_version = 0  # bumped whenever a device or room is added or removed
+        self.device_list = None  # (structure_version, minimal info per device), built by the server
 
     def get_next_device_id(self):
         device_id = self.next_device_id
@@ -117,12 +176,44 @@ class SmartHouse:
             raise ValueError(f"Room ID {room.room_id} already exists.")
         room.set_house(self)
         self.rooms[room.room_id] = room
+        self.index_room(room)
+
+    def remove_room(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room:
+            self.unindex_room(room_id)
+        return room
+
+    def index_room(self, room):
+        """(Re)index every device in a room into devices_by_id."""
+        self.unindex_room(room.room_id)
+        for device_id, device in room.device_map.items():
+            self.devices_by_id[(room.room_id, device_id)] = (device, device.device_type)
+
+    def structure_changed(self):
+        self.structure_version += 1
+        self.device_list = None
+
+    def unindex_room(self, room_id):
+        self.structure_changed()
+        for key in [key for key in self.devices_by_id if key[0] == room_id]:
+            del self.devices_by_id[key]
+
+    def index_device(self, room_id, device):
+        self.structure_changed()
+        self.devices_by_id[(room_id, device.device_id)] = (device, device.device_type)
+
+    def unindex_device(self, room_id, device_id):
+        self.structure_changed()
+        self.devices_by_id.pop((room_id, device_id), None)
 
     def __str__(self):
         return f"SmartHouse {self.house_id} - {self.name}, Rooms: {list(self.rooms.keys())}"
 
 
 class Alarm:
+    device_type = "Alarm"  # type tag, cheaper for the server than type(device).__name__
+
     def __init__(self, code: int, threshold: int = 3):
         self.code = code
         self.is_armed = False
@@ -179,6 +270,8 @@ class Alarm:
 
 
 class Lamp:
+    device_type = "Lamp"
+
     def __init__(self, device_id: int, on: bool = False, shade: int = 100, color: str = "white"):
         """
         Initialize a Lamp.
@@ -234,6 +327,8 @@ class Lamp:
 
 
 class CeilingLight:
+    device_type = "CeilingLight"
+
     def __init__(self, device_id: int, on: bool = False, shade: int = 100, color: str = "white"):
         """
         Initialize a Ceiling Light.
@@ -290,6 +385,8 @@ class CeilingLight:
 
 
 class Lock:
+    device_type = "Lock"
+
     def __init__(self, device_id: int, code: list[int], is_unlocked: bool = False):
         """
         Initialize a Lock.
@@ -339,6 +436,8 @@ class Lock:
         return f"Lock {self.device_id}: {'Unlocked' if self.is_unlocked else 'Locked'}"
 
 class Blinds:
+    device_type = "Blinds"
+
     def __init__(self, device_id: int, is_up: bool = True, is_open: bool = False):
         """
         Initialize Blinds.
@@ -0,0 +1,80 @@
+# server/auth.py
+import hashlib
+import hmac
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logger = logging.getLogger("Auth")
+
+# scrypt cost parameters (~16MB and tens of milliseconds per hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+HASH_PREFIX = "scrypt"
+
+# Hashing is CPU bound, so cap how many run at once no matter how many
+# client threads are logging in simultaneously
+_PWD_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pwd")
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p)
+
+def hash_password(password):
+    """
+    Hash a password for storage in User.password_hash
+
+    Args:
+        password: Plain text password
+
+    Returns:
+        str: Encoded hash in the form scrypt$n$r$p$salt$digest
+    """
+    salt = os.urandom(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{HASH_PREFIX}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+# Checked against when the username doesn't exist, so unknown and known usernames
+# cost the same scrypt work and response time doesn't reveal which ones exist
+_DUMMY_HASH = hash_password(os.urandom(16).hex())
+
+def _verify(password, stored_hash):
+    parts = stored_hash.split("$")
+    if len(parts) != 6 or parts[0] != HASH_PREFIX:
+        # Databases seeded before hashing was added still hold plain text
+        return hmac.compare_digest(password.encode("utf-8"), stored_hash.encode("utf-8"))
+
+    _, n, r, p, salt, digest = parts
+    candidate = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(candidate, bytes.fromhex(digest))
+
+def verify_password(password, stored_hash):
+    """
+    Check a password against a stored hash on the bounded hashing pool
+
+    Args:
+        password: Plain text password from the client
+        stored_hash: Value of User.password_hash, or None for an unknown user;
+            that still runs a full hash and always fails
+
+    Returns:
+        bool: True if the password matches
+    """
+    try:
+        if stored_hash is None:
+            _PWD_POOL.submit(_verify, password, _DUMMY_HASH).result()
+            return False
+        return _PWD_POOL.submit(_verify, password, stored_hash).result()
+    except Exception as e:
+        logger.error(f"Password verification failed: {str(e)}")
+        return False
+
+def needs_rehash(stored_hash):
+    """Whether a stored hash is plain text or uses older scrypt parameters"""
+    parts = stored_hash.split("$")
+    return len(parts) != 6 or parts[:4] != [HASH_PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+
+def rehash_password(password):
+    """Hash a verified password with the current parameters, on the bounded hashing pool"""
+    return _PWD_POOL.submit(hash_password, password).result()
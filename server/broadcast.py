@@ -1,12 +1,196 @@
 # server/broadcast.py
-import json
 import logging
+import orjson
+import queue
+import socket
+import struct
 import threading
 from server.shared_state import state
 
 # Configure logging
 logger = logging.getLogger("Broadcast")
 
+# First header byte of an unfragmented text frame (FIN bit + text opcode)
+TEXT_FRAME_START = 0x81
+
+# Frames a client may have waiting before it is treated as too slow and dropped
+OUTBOX_SIZE = 128
+
+# How long a client's own request thread waits for room in its outbox
+OUTBOX_TIMEOUT = 5.0
+
+# Seconds device updates are buffered per house before being broadcast together
+COALESCE_WINDOW = 0.03
+
+# Websocket client objects of every client that joined a house, keyed by house then client id
+_house_subscribers = {}
+_subscribers_lock = threading.Lock()
+
+# Device updates waiting to be broadcast, keyed by house then by device
+_pending_events = {}
+_flush_timers = {}
+_pending_lock = threading.Lock()
+
+# Held while a house's frames are queued, so buffered updates and immediate
+# broadcasts reach every client in the order they were produced
+_send_locks = {}
+
+def encode_text_frame(payload):
+    """
+    Build the header of a single unmasked websocket text frame
+    
+    Args:
+        payload: UTF-8 encoded message bytes
+        
+    Returns:
+        bytes: Frame header to be written ahead of the payload
+    """
+    length = len(payload)
+    if length <= 125:
+        return struct.pack("!BB", TEXT_FRAME_START, length)
+    elif length <= 65535:
+        return struct.pack("!BBH", TEXT_FRAME_START, 126, length)
+    return struct.pack("!BBQ", TEXT_FRAME_START, 127, length)
+
+def encode_message(message):
+    """
+    Serialize an outgoing message to UTF-8 bytes exactly once
+    
+    Args:
+        message: Pre-encoded bytes, a JSON string, or a serializable object
+        
+    Returns:
+        bytes: UTF-8 encoded message
+    """
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, str):
+        return message.encode("utf-8")
+    # House and room state dicts use int keys
+    return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS)
+
+def send_frames(client, frames):
+    """
+    Write pre-encoded frames to a client socket with one scatter/gather send
+    
+    Args:
+        client: WebSocket client object
+        frames: List of (header, payload) pairs from encode_text_frame
+    """
+    handler = client['handler']
+    buffers = [part for frame in frames for part in frame]
+    try:
+        # Hold the handler's send lock so frames from other threads can't interleave
+        with handler._send_lock:
+            sent = handler.request.sendmsg(buffers)
+            total = sum(len(part) for part in buffers)
+            if sent < total:
+                handler.request.sendall(b"".join(buffers)[sent:])
+    except NotImplementedError:
+        # TLS sockets don't support sendmsg, let the library frame it instead
+        for header, payload in frames:
+            handler.send_message(payload)
+
+def send_frame(client, header, payload):
+    """
+    Write a pre-encoded frame to a client socket immediately, bypassing its outbox
+    
+    Args:
+        client: WebSocket client object
+        header: Frame header from encode_text_frame
+        payload: UTF-8 encoded message bytes
+    """
+    send_frames(client, [(header, payload)])
+
+def _writer_loop(client, outbox):
+    """Drain a client's outbox, coalescing whatever is queued into one send"""
+    while True:
+        frame = outbox.get()
+        if frame is None:
+            return
+        
+        frames = [frame]
+        closing = False
+        while True:
+            try:
+                frame = outbox.get_nowait()
+            except queue.Empty:
+                break
+            if frame is None:
+                closing = True
+                break
+            frames.append(frame)
+        
+        try:
+            send_frames(client, frames)
+        except Exception as e:
+            logger.error(f"Error writing to client {client['id']}: {str(e)}")
+            return
+        
+        if closing:
+            return
+
+def start_writer(client):
+    """
+    Give a client its own bounded outbox and writer thread, so handlers never block on its socket
+    
+    Args:
+        client: WebSocket client object
+    """
+    outbox = queue.Queue(maxsize=OUTBOX_SIZE)
+    client['outbox'] = outbox
+    threading.Thread(
+        target=_writer_loop,
+        args=(client, outbox),
+        name=f"writer-{client['id']}",
+        daemon=True
+    ).start()
+
+def stop_writer(client):
+    """
+    Let a client's writer thread exit once it has flushed what is already queued
+    
+    Args:
+        client: WebSocket client object
+    """
+    outbox = client.pop('outbox', None)
+    if outbox is None:
+        return
+    try:
+        outbox.put_nowait(None)
+    except queue.Full:
+        # The writer is stuck on a dead socket and will exit when the send fails
+        pass
+
+def queue_frame(client, header, payload, block=False):
+    """
+    Queue a pre-encoded frame on a client's outbox
+    
+    Args:
+        client: WebSocket client object
+        header: Frame header from encode_text_frame
+        payload: UTF-8 encoded message bytes
+        block: Wait for room in the outbox; only for replies on the client's own
+            thread, where waiting throttles its reads instead of stalling others
+    """
+    outbox = client.get('outbox')
+    if outbox is None:
+        # No writer (not fully connected yet, or already leaving), write directly
+        send_frame(client, header, payload)
+        return
+    
+    try:
+        outbox.put((header, payload), block=block, timeout=OUTBOX_TIMEOUT)
+    except queue.Full:
+        # A client that can't keep up would otherwise grow its backlog without bound
+        logger.warning(f"Outbox full for client {client['id']}, disconnecting")
+        handler = client['handler']
+        handler.keep_alive = False
+        try:
+            handler.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
 def init_broadcaster(server):
     """
     Initialize the broadcaster with reference to server
@@ -25,9 +209,9 @@ def register_client(house_id, client):
         house_id: ID of the house
         client: WebSocket client object
     """
+    with _subscribers_lock:
+        _house_subscribers.setdefault(house_id, {})[client['id']] = client
     logger.info(f"Client {client['id']} registered for broadcasts to house {house_id}")
-    # No actual registration needed as broadcasts are sent based on client tracking
-    # in the clients dictionary which is updated when joining a house
     
 def unregister_client(house_id, client):
     """
@@ -37,8 +221,35 @@ def unregister_client(house_id, client):
         house_id: ID of the house
         client: WebSocket client object
     """
+    emptied = False
+    with _subscribers_lock:
+        subscribers = _house_subscribers.get(house_id)
+        if subscribers is not None:
+            subscribers.pop(client['id'], None)
+            if not subscribers:
+                del _house_subscribers[house_id]
+                emptied = True
+    if emptied:
+        _discard_send_lock(house_id)
     logger.info(f"Client {client['id']} unregistered from broadcasts to house {house_id}")
 
+def _house_recipients(house_id, exclude_client_id=None):
+    """Snapshot the websocket client objects subscribed to a house"""
+    with _subscribers_lock:
+        subscribers = _house_subscribers.get(house_id)
+        if not subscribers:
+            return []
+        # Skip excluded client (originator of the request)
+        return [client for client_id, client in subscribers.items() if client_id != exclude_client_id]
+
+def has_recipients(house_id, exclude_client_id=None):
+    """Check whether a broadcast to a house would reach anyone besides the excluded client"""
+    # Read without the lock: a client joining concurrently gets the full house state on join
+    subscribers = _house_subscribers.get(house_id)
+    if not subscribers:
+        return False
+    return len(subscribers) > 1 or exclude_client_id not in subscribers
+
 def broadcast_to_house(house_id, message, exclude_client_id=None):
     """
     Broadcast a message to all clients connected to a specific house,
@@ -46,7 +257,7 @@ def broadcast_to_house(house_id, message, exclude_client_id=None):
     
     Args:
         house_id: ID of the house to broadcast to
-        message: Message to broadcast (string or serializable object)
+        message: Message to broadcast (bytes, string or serializable object)
         exclude_client_id: Optional client ID to exclude from broadcast
     """
     server = state.get_server()
@@ -54,49 +265,147 @@ def broadcast_to_house(house_id, message, exclude_client_id=None):
         logger.error("Broadcaster not initialized")
         return
     
-    # Convert message to string if it's not already
-    data = message if isinstance(message, str) else json.dumps(message)
+    # Nobody to order frames for, so don't create a send lock for the house
+    if house_id not in _house_subscribers and house_id not in _pending_events:
+        return
     
-    client_count = 0
-    house_clients = state.get_house_clients(house_id)
+    with _house_send_lock(house_id):
+        # Device updates still in the coalescing window happened before this message
+        _send_pending(house_id)
+        
+        recipients = _house_recipients(house_id, exclude_client_id)
+        
+        # Nothing to serialize when the originator is the only client in the house
+        if not recipients:
+            return
+        
+        # Encode the payload and frame header once, then reuse them for every recipient
+        payload = encode_message(message)
+        header = encode_text_frame(payload)
+        
+        client_count = 0
+        for client_obj in recipients:
+            try:
+                queue_frame(client_obj, header, payload)
+                client_count += 1
+            except Exception as e:
+                logger.error(f"Error broadcasting to client {client_obj['id']}: {str(e)}")
     
-    for client_id, client_data in house_clients.items():
-        # Skip excluded client (originator of the request)
-        if exclude_client_id and client_id == exclude_client_id:
+    logger.debug("Broadcasted message to %s clients in house %s (excluding %s)", client_count, house_id, exclude_client_id)
+
+def coalesce_to_house(house_id, message, exclude_client_id=None):
+    """
+    Buffer a device update for a house and broadcast everything buffered in
+    the same short window together, so bursts of actions (e.g. a dimmer being
+    dragged) cost one serialization and one write per client.
+    
+    Args:
+        house_id: ID of the house to broadcast to
+        message: Update message dict, superseded by later updates to the same device
+        exclude_client_id: Optional client ID that shouldn't receive this update
+    """
+    with _pending_lock:
+        pending = _pending_events.setdefault(house_id, {})
+        # Only the latest state of a device matters, so a newer update replaces an older one
+        if message.get("device_id") is not None:
+            key = (message.get("type"), message.get("room_id"), message.get("device_id"))
+        else:
+            key = len(pending)
+        pending.pop(key, None)
+        pending[key] = (message, exclude_client_id)
+        
+        if house_id not in _flush_timers:
+            timer = threading.Timer(COALESCE_WINDOW, _flush_house, args=(house_id,))
+            timer.daemon = True
+            _flush_timers[house_id] = timer
+            timer.start()
+
+def _house_send_lock(house_id):
+    """Get the lock that orders frames queued for a house"""
+    with _pending_lock:
+        lock = _send_locks.get(house_id)
+        if lock is None:
+            lock = _send_locks[house_id] = threading.Lock()
+        return lock
+
+def _discard_send_lock(house_id):
+    """Forget a house's send lock once it has no subscribers and nothing buffered"""
+    with _pending_lock:
+        # Membership reads are atomic, and _subscribers_lock is never taken inside _pending_lock
+        if house_id not in _house_subscribers and house_id not in _pending_events:
+            _send_locks.pop(house_id, None)
+
+def _flush_house(house_id):
+    """Timer callback that sends a house's buffered updates once the coalescing window closes"""
+    with _house_send_lock(house_id):
+        _send_pending(house_id)
+    # The last client may have left while the updates were buffered
+    if house_id not in _house_subscribers:
+        _discard_send_lock(house_id)
+
+def _send_pending(house_id):
+    """
+    Send a house's buffered updates, leaving each client's own updates out of what it receives.
+    Must be called with the house's send lock held.
+    """
+    with _pending_lock:
+        events = list(_pending_events.pop(house_id, {}).values())
+        timer = _flush_timers.pop(house_id, None)
+    
+    # Flushed early by an immediate broadcast, so the window's timer has nothing left to do
+    if timer is not None:
+        timer.cancel()
+    
+    server = state.get_server()
+    if not events or not server:
+        return
+    
+    # Clients that see the same subset of events share one encoded frame
+    frames = {}
+    client_count = 0
+    for client_obj in _house_recipients(house_id):
+        visible = tuple(i for i, (_, exclude_id) in enumerate(events) if exclude_id != client_obj['id'])
+        if not visible:
             continue
-            
-        try:
-            # Find the client object by ID in server clients list
-            client_obj = next((c for c in server.clients if c['id'] == client_id), None)
-            if client_obj:
-                server.send_message(client_obj, data)
-                client_count += 1
+        
+        frame = frames.get(visible)
+        if frame is None:
+            if len(visible) == 1:
+                # A lone update goes out unchanged
+                message = events[visible[0]][0]
             else:
-                logger.warning(f"Client {client_id} not found in server clients")
+                message = {"type": "batch_update", "events": [events[i][0] for i in visible]}
+            payload = encode_message(message)
+            frame = frames[visible] = (encode_text_frame(payload), payload)
+        
+        try:
+            queue_frame(client_obj, *frame)
+            client_count += 1
         except Exception as e:
-            logger.error(f"Error broadcasting to client {client_id}: {str(e)}")
+            logger.error(f"Error broadcasting to client {client_obj['id']}: {str(e)}")
     
-    logger.debug(f"Broadcasted message to {client_count} clients in house {house_id} (excluding {exclude_client_id})")
+    logger.debug("Flushed %s coalesced updates to %s clients in house %s", len(events), client_count, house_id)
 
 def broadcast_to_all(message):
     """
     Broadcast a message to all connected clients
     
     Args:
-        message: Message to broadcast (string or serializable object)
+        message: Message to broadcast (bytes, string or serializable object)
     """
     server = state.get_server()
     if not server:
         logger.error("Broadcaster not initialized")
         return
     
-    # Convert message to string if it's not already
-    data = message if isinstance(message, str) else json.dumps(message)
+    # Encode once and share the same frame across every client
+    payload = encode_message(message)
+    header = encode_text_frame(payload)
     
     for client in server.clients:
         try:
-            server.send_message(client, data)
+            queue_frame(client, header, payload)
         except Exception as e:
             logger.error(f"Error broadcasting to client {client['id']}: {str(e)}")
             
-    logger.debug(f"Broadcasted message to all {len(server.clients)} clients")
\ No newline at end of file
+    logger.debug("Broadcasted message to all %s clients", len(server.clients))
\ No newline at end of file
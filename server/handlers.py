@@ -1,47 +1,71 @@
-import json
 import logging
+from operator import methodcaller
+from types import MappingProxyType
+from sqlalchemy import delete
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import load_only
 from db.setup import SessionLocal
 from model.db import User, House, HouseUserRole
 from model.db import Lamp as LampORM, Lock as LockORM, Blinds as BlindsORM, CeilingLight as CeilingLightORM, Alarm as AlarmORM
 from model.db import Room as RoomORM
-from model.bridge import domain_user_from_orm, domain_house_from_orm
-from model.bridge import update_orm_lamp_from_domain, update_orm_lock_from_domain, update_orm_blinds_from_domain
-from model.bridge import update_orm_ceiling_light_from_domain, update_orm_alarm_from_domain
-from server.broadcast import register_client, unregister_client, broadcast_to_house
+from model.bridge import domain_user_from_orm, domain_house_from_orm, HOUSE_LOAD_OPTIONS
+from model.bridge import lamp_to_mapping, lock_to_mapping, blinds_to_mapping, ceiling_light_to_mapping, alarm_to_mapping
+from server.broadcast import register_client, unregister_client, broadcast_to_house, coalesce_to_house, has_recipients
 from model.domain import User, SmartHouse, Room, Lamp, Lock, Blinds, CeilingLight, Alarm
 from server.shared_state import state
+from server.write_batcher import device_writer
 
 # Configure logging
 logger = logging.getLogger("Handlers")
 
-# Define a mapping of device types to their ORM classes and update functions
+# Define a mapping of device types to their ORM classes and row mapping builders
 DEVICE_MAPPINGS = {
     "Lamp": {
         "orm_class": LampORM,
-        "update_func": update_orm_lamp_from_domain
+        "to_mapping": lamp_to_mapping
     },
     "Lock": {
         "orm_class": LockORM,
-        "update_func": update_orm_lock_from_domain
+        "to_mapping": lock_to_mapping
     },
     "Blinds": {
         "orm_class": BlindsORM,
-        "update_func": update_orm_blinds_from_domain
+        "to_mapping": blinds_to_mapping
     },
     "CeilingLight": {
         "orm_class": CeilingLightORM,
-        "update_func": update_orm_ceiling_light_from_domain
+        "to_mapping": ceiling_light_to_mapping
     },
     "Alarm": {
         "orm_class": AlarmORM,
-        "update_func": update_orm_alarm_from_domain
+        "to_mapping": alarm_to_mapping
     }
 }
 
+# Device types the group handlers accept; listing also covers the house-level alarm
+GROUP_DEVICE_TYPES = ("Lamp", "Lock", "CeilingLight", "Blinds")
+VALID_GROUP_TYPES = frozenset(GROUP_DEVICE_TYPES)
+INVALID_GROUP_TYPE_MESSAGE = f"Invalid device type. Must be one of: {', '.join(GROUP_DEVICE_TYPES)}"
+VALID_LIST_TYPES = VALID_GROUP_TYPES | {"Alarm"}
+
+# Broadcast message types per device type, e.g. "CeilingLight" -> "ceilinglight_update"
+UPDATE_TOPICS = {device_type: f"{device_type.lower()}_update" for device_type in VALID_LIST_TYPES}
+GROUP_UPDATE_TOPICS = {device_type: f"{device_type.lower()}_group_update" for device_type in GROUP_DEVICE_TYPES}
+INVALID_LIST_TYPE_MESSAGE = f"Invalid device type. Must be one of: {', '.join(GROUP_DEVICE_TYPES + ('Alarm',))}"
+
 def is_alarm_triggered(house):
     """Check if the house alarm is triggered"""
     return house.alarm and house.alarm.is_alarm and house.alarm.is_armed
 
+def check_alarm_lockout(house, user):
+    """Return the error response if the alarm locks this user out of the house, else None"""
+    if house is not None and is_alarm_triggered(house) and not user.can_modify_structure():
+        return {
+            "status": "error",
+            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
+        }
+    return None
+
 def notify_alarm_triggered(house_id):
     """Broadcast an alarm notification to all clients in the house"""
     broadcast_message = {
@@ -58,11 +82,9 @@ def get_device_from_house(house, room_id, device_id):
         if house.alarm and str(house.alarm.device_id) == str(device_id):
             return house.alarm
             
-    # Normal case for room devices
-    room = house.rooms.get(room_id)
-    if not room:
-        return None
-    return room.device_map.get(device_id)
+    # Normal case for room devices, one probe of the house-wide index
+    entry = house.devices_by_id.get((room_id, device_id))
+    return entry[0] if entry else None
         
 def handle_device_action(house, user, session, request_data, client_id=None):
     """
@@ -73,47 +95,50 @@ def handle_device_action(house, user, session, request_data, client_id=None):
     device_id = request_data.get("device_id")
     action = request_data.get("action")
     params = request_data.get("params", {})
-    device = get_device_from_house(house, room_id, device_id)
-    device_type = type(device).__name__ if device else None
     
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
 
     # Authorization check
     if not user.can_control():
         return {"status": "error", "message": "User lacks permission to control devices"}
     
-    # Get the device
+    # Get the device, only once the request is allowed to touch it
     device = get_device_from_house(house, room_id, device_id)
     if not device:
         return {"status": "error", "message": f"Device {device_id} not found in room {room_id}"}
+    device_type = device.device_type
     
     # Execute the action on the device
     try:
         result = execute_device_action(device, action, params)
+        if result is NOOP:
+            # Nothing changed (e.g. a repeated "off"), so there is nothing to write or broadcast
+            return {
+                "status": "success",
+                "device_id": device_id,
+                "device_type": device_type,
+                "room_id": room_id,
+                "action": action,
+                "noop": True,
+                "device_state": device.check_status()
+            }
+        
+        room = house.rooms.get(room_id)
+        if room:
+            room.touch()
         
         # IMPORTANT: Check alarm state again after the action (in case it triggered the alarm)
         if is_alarm_triggered(house) and not user.can_modify_structure():
             # Still perform the action but notify about alarm state
             notify_alarm_triggered(house.house_id)
             
-        # Sync changes to the database
+        # Queue the new state for the background writer instead of committing per action
         mapping = DEVICE_MAPPINGS.get(device_type)
         if mapping:
-            orm_class = mapping["orm_class"]
-            update_func = mapping["update_func"]
-            
-            device_orm = session.query(orm_class).filter_by(id=device_id).first()
-            if device_orm:
-                update_func(device, device_orm)
-                session.commit()
-                logger.info(f"Updated device {device_id} ({device_type}) in database")
-            else:
-                logger.warning(f"Could not find device {device_id} ({device_type}) in database")
+            device_writer.submit(mapping["orm_class"], mapping["to_mapping"](device, room_id))
         
         # Include device status in the response
         device_status = device.check_status()
@@ -128,23 +153,28 @@ def handle_device_action(house, user, session, request_data, client_id=None):
             "device_state": device_status
         }
 
-        # Make broadcast message consistent
-        broadcast_message = {
-            "type": f"{device_type.lower()}_update",
-            "device_id": device_id,
-            "room_id": room_id, 
-            "action": action,
-            "status": device_status
-        }
+        # Invalidate the cached house state before other clients hear about the change
+        state.bump_house_version(house.house_id)
     
-        # Pass the client_id to exclude it from broadcast
-        broadcast_to_house(house.house_id, broadcast_message, exclude_client_id=client_id)
-        logger.info(f"Broadcasted update for device {device_id} to house {house.house_id} (excluding client {client_id})")
+        # With nobody else in the house there is no update to build or buffer
+        if has_recipients(house.house_id, client_id):
+            # Make broadcast message consistent
+            broadcast_message = {
+                "type": UPDATE_TOPICS[device_type],
+                "device_id": device_id,
+                "room_id": room_id, 
+                "action": action,
+                "status": device_status
+            }
+        
+            # Pass the client_id to exclude it from broadcast; rapid updates are batched per house
+            coalesce_to_house(house.house_id, broadcast_message, exclude_client_id=client_id)
+            logger.info("Queued update for device %s to house %s (excluding client %s)", device_id, house.house_id, client_id)
         
         return response
         
-    except Exception as e:
-        logger.error(f"Error executing device action: {str(e)}")
+    except ValueError as e:
+        # Domain validation errors are written for the user
         return {"status": "error", "message": str(e)}
     
 def handle_device_status(request_data, house, user):
@@ -155,37 +185,45 @@ def handle_device_status(request_data, house, user):
     if not device:
         return {"type": "error", "message": "Device not found"}
 
+    # Room devices answer from the room's snapshot, rebuilt only after the room changes
+    room = house.rooms.get(room_id)
+    if room is not None:
+        entry = get_room_state(room)["devices"][device.device_id]
+        device_type, status = entry["type"], entry["status"]
+    else:
+        device_type, status = device.device_type, device.check_status()
+
     return {
         "type": "device_status",
         "device_id": device.device_id,
-        "device_type": type(device).__name__,
-        "status": device.check_status()
+        "device_type": device_type,
+        "status": status
     }
 
 def handle_device_group_status(request_data, house, user):
     """Handle request to check status of all devices of a specific type"""
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
 
     device_type = request_data.get("device_type")
-    valid_types = ["Lamp", "Lock", "CeilingLight", "Blinds"]
-    
-    if not device_type or device_type not in valid_types:
-        return {"type": "error", "message": f"Invalid device type. Must be one of: {', '.join(valid_types)}"}
+    if not device_type or device_type not in VALID_GROUP_TYPES:
+        return {"type": "error", "message": INVALID_GROUP_TYPE_MESSAGE}
     
     devices = {}
     # Collect all devices of the specified type across all rooms
     for room_id, room in house.rooms.items():
-        for device_id, device in room.device_map.items():
-            if type(device).__name__ == device_type:
-                devices[device_id] = {
-                    "room_id": room_id,
-                    "status": device.check_status()
-                }
+        matching = room.devices_by_type.get(device_type)
+        if not matching:
+            continue
+        # Read statuses from the room snapshot instead of calling check_status per device
+        snapshot = get_room_state(room)["devices"]
+        for device_id in matching:
+            devices[device_id] = {
+                "room_id": room_id,
+                "status": snapshot[device_id]["status"]
+            }
     
     return {
         "type": "device_group_status",
@@ -195,61 +233,78 @@ def handle_device_group_status(request_data, house, user):
 
 def handle_device_group_action(house, user, session, request_data):
     """Handle action on all devices of a specific type"""
+    # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
+
+    # Authorization check
     if not user.can_control():
         return {"status": "error", "message": "User lacks permission to control devices"}
+    
     device_type = request_data.get("device_type")
     action = request_data.get("action")
     params = request_data.get("params", {})
     
-    valid_types = ["Lamp", "Lock", "CeilingLight", "Blinds"]
-    if not device_type or device_type not in valid_types:
-        return {"status": "error", "message": f"Invalid device type. Must be one of: {', '.join(valid_types)}"}
-    
-    # Authorization check
-    if not user.can_control():
-        return {"status": "error", "message": "User lacks permission to control devices"}
+    if not device_type or device_type not in VALID_GROUP_TYPES:
+        return {"status": "error", "message": INVALID_GROUP_TYPE_MESSAGE}
     
     results = {"succeeded": [], "failed": []}
     
+    targets = [
+        (room_id, room, device_id, device)
+        for room_id, room in house.rooms.items()
+        for device_id, device in room.devices_by_type.get(device_type, {}).items()
+    ]
+    
+    mapping = DEVICE_MAPPINGS.get(device_type)
+    
+    # Every target has the same type, so resolve the action once; an action the type
+    # doesn't support fails every device without raising once per device
+    run, error = resolve_device_action(device_type, action)
+    if run is None:
+        results["failed"] = [
+            {"device_id": device_id, "room_id": room_id, "reason": error}
+            for room_id, _, device_id, _ in targets
+        ]
+        targets = []
+    params = params or NO_PARAMS
+    
     # Execute action on all devices of the specified type
-    for room_id, room in house.rooms.items():
-        for device_id, device in room.device_map.items():
-            if type(device).__name__ == device_type:
-                try:
-                    execute_device_action(device, action, params)
-                    
-                    # Update the database for this device
-                    mapping = DEVICE_MAPPINGS.get(device_type)
-                    if mapping:
-                        orm_class = mapping["orm_class"]
-                        update_func = mapping["update_func"]
-                        
-                        device_orm = session.query(orm_class).filter_by(id=device_id).first()
-                        if device_orm:
-                            update_func(device, device_orm)
-                            results["succeeded"].append({
-                                "device_id": device_id,
-                                "room_id": room_id
-                            })
-                        else:
-                            results["failed"].append({
-                                "device_id": device_id,
-                                "room_id": room_id,
-                                "reason": "Device not found in database"
-                            })
-                except Exception as e:
-                    results["failed"].append({
-                        "device_id": device_id,
-                        "room_id": room_id,
-                        "reason": str(e)
-                    })
-    
-    # Commit all changes at once
-    session.commit()
+    for room_id, room, device_id, device in targets:
+        try:
+            if run(device, params) is NOOP:
+                # Already in the requested state, the stored row is still current
+                results["succeeded"].append({
+                    "device_id": device_id,
+                    "room_id": room_id
+                })
+                continue
+            room.touch()
+            
+            # Queue the row for the background writer, which sends every queued row of a
+            # class as one executemany UPDATE; sharing its queue with single device actions
+            # also keeps a stale pending update from landing after this one
+            if mapping:
+                device_writer.submit(mapping["orm_class"], mapping["to_mapping"](device, room_id))
+            results["succeeded"].append({
+                "device_id": device_id,
+                "room_id": room_id
+            })
+        except ValueError as e:
+            # Domain validation, e.g. a dim level out of range
+            results["failed"].append({
+                "device_id": device_id,
+                "room_id": room_id,
+                "reason": str(e)
+            })
+    
+    # Invalidate the cached house state before other clients hear about the change
+    state.bump_house_version(house.house_id)
     
     # Broadcast updates
     broadcast_message = {
-        "type": f"{device_type.lower()}_group_update",
+        "type": GROUP_UPDATE_TOPICS[device_type],
         "device_type": device_type,
         "action": action,
         "results": results
@@ -265,25 +320,32 @@ def handle_device_group_action(house, user, session, request_data):
 
 def handle_list_house_devices(house, user):
     """List all devices in the house with minimal info"""
-    devices = []
-    
-    # Add house alarm if present
-    if house.alarm:
-        devices.append({
-            "device_id": house.alarm.device_id,
-            "type": "Alarm",
-            "room_id": None  # House-level device
-        })
-    
-    # Add all room devices
-    for room_id, room in house.rooms.items():
-        for device_id, device in room.device_map.items():
-            devices.append({
+    # The list only changes when devices or rooms are added or removed, which bumps the
+    # structure version; a list built across such a change is never served or kept
+    version = house.structure_version
+    cached = house.device_list
+    if cached is not None and cached[0] == version:
+        devices = cached[1]
+    else:
+        devices = [
+            {
                 "device_id": device_id,
-                "type": type(device).__name__,
+                "type": device.device_type,
                 "room_id": room_id,
                 "room_name": room.name
+            }
+            for room_id, room in house.rooms.items()
+            for device_id, device in room.device_map.items()
+        ]
+        # Add house alarm if present
+        if house.alarm:
+            devices.insert(0, {
+                "device_id": house.alarm.device_id,
+                "type": "Alarm",
+                "room_id": None  # House-level device
             })
+        if house.structure_version == version:
+            house.device_list = (version, devices)
     
     return {
         "type": "device_list",
@@ -302,7 +364,7 @@ def handle_list_room_devices(house, user, room_id):
     for device_id, device in room.device_map.items():
         devices.append({
             "device_id": device_id,
-            "type": type(device).__name__
+            "type": device.device_type
         })
     
     return {
@@ -316,10 +378,8 @@ def handle_list_room_devices(house, user, room_id):
 
 def handle_list_group_devices(house, user, device_type):
     """List all devices of a specific type across the house"""
-    valid_types = ["Lamp", "Lock", "CeilingLight", "Blinds", "Alarm"]
-    
-    if not device_type or device_type not in valid_types:
-        return {"type": "error", "message": f"Invalid device type. Must be one of: {', '.join(valid_types)}"}
+    if not device_type or device_type not in VALID_LIST_TYPES:
+        return {"type": "error", "message": INVALID_LIST_TYPE_MESSAGE}
     
     devices = []
     
@@ -333,13 +393,12 @@ def handle_list_group_devices(house, user, device_type):
     
     # Add all matching devices from rooms
     for room_id, room in house.rooms.items():
-        for device_id, device in room.device_map.items():
-            if type(device).__name__ == device_type:
-                devices.append({
-                    "device_id": device_id,
-                    "room_id": room_id,
-                    "room_name": room.name
-                })
+        for device_id in room.devices_by_type.get(device_type, {}):
+            devices.append({
+                "device_id": device_id,
+                "room_id": room_id,
+                "room_name": room.name
+            })
     
     return {
         "type": "device_list",
@@ -349,81 +408,122 @@ def handle_list_group_devices(house, user, device_type):
         "devices": devices
     }
 
+# Returned by execute_device_action when the device was already in the requested state
+NOOP = object()
+
+# Shared read-only stand-in for requests without params, instead of a new dict per action
+NO_PARAMS = MappingProxyType({})
+
+def _set_state(method_name, attr, value):
+    """Action that moves a device into a fixed state, reporting NOOP if it is already there"""
+    call = methodcaller(method_name)
+    def run(device, params):
+        if getattr(device, attr) == value:
+            return NOOP
+        return call(device)
+    return run
+
+def _no_args(method_name):
+    call = methodcaller(method_name)
+    def run(device, params):
+        return call(device)
+    return run
+
+def _one_arg(method_name, key, default):
+    def run(device, params):
+        return getattr(device, method_name)(params.get(key, default))
+    return run
+
+def _unlock(device, params):
+    result = device.unlock(params.get("code", ""))
+    # Check if this failed unlock attempt triggered the alarm
+    if not result and hasattr(device, '_room'):  # result will be False for failed unlock
+        for room_id, room in device._room.items():
+            if hasattr(room, 'house') and room.house and room.house.alarm:
+                if room.house.alarm.is_alarm:
+                    notify_alarm_triggered(room.house.house_id)
+    return result
+
+# Each device type only lists the actions it supports, so an action name can
+# mean different methods on different devices
+LIGHT_ACTIONS = {
+    "toggle": _no_args("flip_switch"),
+    "on": _set_state("turn_on", "on", True),
+    "off": _set_state("turn_off", "on", False),
+    "dim": _one_arg("set_shade", "level", 100),
+    "color": _one_arg("change_color", "color", "white")
+}
+
+LOCK_ACTIONS = {
+    "lock": _set_state("lock", "is_unlocked", False),
+    "unlock": _unlock
+}
+
+BLINDS_ACTIONS = {
+    "toggle": _no_args("toggle"),  # For blinds position
+    "up": _set_state("set_up", "is_up", True),
+    "down": _set_state("set_down", "is_up", False),
+    "shutter": _no_args("shutter"),
+    "open": _set_state("set_open", "is_open", True),
+    "close": _set_state("set_close", "is_open", False)
+}
+
+ALARM_ACTIONS = {
+    "arm": _no_args("arm"),
+    "disarm": _no_args("disarm"),
+    "trigger": _no_args("trigger_alarm")
+}
+
+# Device type -> {action name: callable(device, params)}
+DEVICE_ACTIONS = {
+    "Lamp": LIGHT_ACTIONS,
+    "CeilingLight": LIGHT_ACTIONS,
+    "Lock": LOCK_ACTIONS,
+    "Blinds": BLINDS_ACTIONS,
+    "Alarm": ALARM_ACTIONS
+}
+
+# Flattened to (device type, action) -> callable at import, so dispatch is a single lookup
+ACTION_DISPATCH = {
+    (device_type, action): run
+    for device_type, actions in DEVICE_ACTIONS.items()
+    for action, run in actions.items()
+}
+
+# Every action some device supports, to tell unknown actions from unsupported ones
+KNOWN_ACTIONS = frozenset(action for _, action in ACTION_DISPATCH)
+
+def resolve_device_action(device_type, action):
+    """
+    Look up the adapter for an action on a device type.
+    Returns (adapter, None), or (None, error message) if the action can't be run.
+    """
+    run = ACTION_DISPATCH.get((device_type, action))
+    if run is not None:
+        return run, None
+    if action in KNOWN_ACTIONS:
+        return None, f"Device does not support action: {action}"
+    return None, f"Unknown action: {action}"
+
 def execute_device_action(device, action, params):
     """
     Execute an action on a device with the given parameters.
-    Uses reflection to call methods on the device object.
+    Dispatches on (device type, action) through ACTION_DISPATCH.
+    Returns NOOP when the device was already in the requested state.
     """
-    # Map action names to method names
-    method_map = {
-        # Light actions
-        "toggle": "flip_switch",
-        "on": "turn_on",
-        "off": "turn_off",
-        "dim": "set_shade",
-        "color": "change_color",
-        
-        # Lock actions
-        "lock": "lock",
-        "unlock": "unlock",
-        
-        # Blinds actions
-        "toggle": "toggle",  # For blinds position
-        "up": "set_up",
-        "down": "set_down",
-        "shutter": "shutter",
-        "open": "set_open",
-        "close": "set_close",
-        
-        # Alarm actions
-        "arm": "arm",
-        "disarm": "disarm",
-        "trigger": "trigger_alarm",
-        "stop": "stop_alarm"
-    }
-    
-    method_name = method_map.get(action)
-    if not method_name:
-        raise ValueError(f"Unknown action: {action}")
-    
-    # Get the method from the device
-    method = getattr(device, method_name, None)
-    if not method:
-        raise ValueError(f"Device does not support action: {action}")
-    
-    # Call the method with parameters
-    if params:
-        # Extract parameters based on the action
-        if action == "dim":
-            return method(params.get("level", 100))
-        elif action == "color":
-            return method(params.get("color", "white"))
-        elif action == "unlock":
-            result = method(params.get("code", ""))
-            # Check if this failed unlock attempt triggered the alarm
-            if not result and hasattr(device, '_room'):  # result will be False for failed unlock
-                for room_id, room in device._room.items():
-                    if hasattr(room, 'house') and room.house and room.house.alarm:
-                        if room.house.alarm.is_alarm:
-                            from server.handlers import notify_alarm_triggered
-                            notify_alarm_triggered(room.house.house_id)
-            return result
-        else:
-            return method(**params)
-    else:
-        return method()
+    run, error = resolve_device_action(device.device_type, action)
+    if run is None:
+        raise ValueError(error)
+    return run(device, params or NO_PARAMS)
     
 def get_house_state(house):
     """Get the complete state of a house including all rooms and devices"""
     state_data = {
         "house_id": house.house_id,
         "name": house.name,
-        "rooms": {}
+        "rooms": {room_id: get_room_state(room) for room_id, room in house.rooms.items()}
     }
     
-    for room_id, room in house.rooms.items():
-        state_data["rooms"][room_id] = get_room_state(room)
-    
     if house.alarm:
         state_data["alarm"] = {
             "device_id": house.alarm.device_id,
@@ -435,19 +535,24 @@ def get_house_state(house):
 
 def get_room_state(room):
     """Get the state of a room including all devices using device_map"""
+    # Rooms nobody has touched since the last snapshot reuse it as is;
+    # callers only serialize the result, never modify it
+    version = room.state_version
+    cached = room.state_cache
+    if cached and cached[0] == version:
+        return cached[1]
+    
+    # Use device_map to get all devices, built in one pass
     state_data = {
         "room_id": room.room_id,
         "name": room.name,
-        "devices": {}
-    }
-    
-    # Use device_map to get all devices
-    for device_id, device in room.device_map.items():
-        state_data["devices"][device_id] = {
-            "type": type(device).__name__,
-            "status": device.check_status()
+        "devices": {
+            device_id: {"type": device.device_type, "status": device.check_status()}
+            for device_id, device in room.device_map.items()
         }
+    }
     
+    room.state_cache = (version, state_data)
     return state_data
 
 
@@ -460,11 +565,9 @@ def handle_add_room(data, session, user):
     house = state.get_house(house_id)
 
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
 
     if not user.can_modify_structure():
         return {"status": "error", "message": "Permission denied."}
@@ -476,7 +579,6 @@ def handle_add_room(data, session, user):
 
     if house:
         # Create a domain room object with the new room's ID
-        from model.domain import Room
         room = Room(room_id=new_room.id, name=name)
         # Add to house
         house.add_room(room)
@@ -491,6 +593,34 @@ def handle_add_room(data, session, user):
     }
 
 
+def _light_kwargs(attrs):
+    return {
+        "on": attrs.get("on", False),
+        "shade": attrs.get("shade", 100),
+        "color": attrs.get("color", "white")
+    }
+
+def _lock_kwargs(attrs):
+    code = attrs.get("code", "0000")
+    return {
+        "code": code.split(",") if "," in code else [code],
+        "is_unlocked": attrs.get("is_unlocked", False)
+    }
+
+def _blinds_kwargs(attrs):
+    return {
+        "is_up": attrs.get("is_up", True),
+        "is_open": attrs.get("is_open", False)
+    }
+
+# Requested device type -> (ORM class, domain class, domain constructor kwargs with defaults applied)
+DEVICE_FACTORIES = {
+    "lamp": (LampORM, Lamp, _light_kwargs),
+    "lock": (LockORM, Lock, _lock_kwargs),
+    "blinds": (BlindsORM, Blinds, _blinds_kwargs),
+    "ceiling_light": (CeilingLightORM, CeilingLight, _light_kwargs)
+}
+
 def handle_add_device(data, session, user):
     """Handle adding a new device to a room with unique device ID"""
     house_id = data.get("house_id")
@@ -504,22 +634,21 @@ def handle_add_device(data, session, user):
         return {"status": "error", "message": "House not found in memory"}
     
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
 
     if not user.can_modify_structure():
         return {"status": "error", "message": "Permission denied."}
 
     # Validate device type
-    valid_device_types = ["lamp", "lock", "blinds", "ceiling_light"]
-    if device_type.lower() not in valid_device_types:
+    factory = DEVICE_FACTORIES.get((device_type or "").lower())
+    if not factory:
         return {
             "status": "error", 
-            "message": f"Invalid device type: '{device_type}'. Valid types are: {', '.join(valid_device_types)}"
+            "message": f"Invalid device type: '{device_type}'. Valid types are: {', '.join(DEVICE_FACTORIES)}"
         }
+    orm_class, domain_class, domain_kwargs = factory
 
 
     if not house:
@@ -533,9 +662,9 @@ def handle_add_device(data, session, user):
     # Get a unique device ID for the new device within this room
     device_id = domain_room.get_next_device_id()
     
-    # Get actual Room DB entry using house_id + room_id
-    room_orm = session.query(RoomORM).filter_by(house_id=house_id, id=room_id).first()
-    if not room_orm:
+    # Get actual Room DB entry by primary key, then make sure it belongs to this house
+    room_orm = session.get(RoomORM, room_id)
+    if not room_orm or room_orm.house_id != house_id:
         return {"status": "error", "message": "Room not found in database."}
     
     # Update the next_device_id in the database for this room
@@ -543,53 +672,12 @@ def handle_add_device(data, session, user):
 
     try:
         # Create the device with the assigned ID
-        if device_type.lower() == "lamp":
-            dev = LampORM(id=device_id, room_id=room_orm.id, **attrs)
-        elif device_type.lower() == "lock":
-            dev = LockORM(id=device_id, room_id=room_orm.id, **attrs)
-        elif device_type.lower() == "blinds":
-            dev = BlindsORM(id=device_id, room_id=room_orm.id, **attrs)
-        elif device_type.lower() == "ceiling_light":
-            dev = CeilingLightORM(id=device_id, room_id=room_orm.id, **attrs)
-        
+        dev = orm_class(id=device_id, room_id=room_orm.id, **attrs)
         session.add(dev)
         session.commit()
         
-        # Also update domain model
-        if device_type.lower() == "lamp":
-            domain_device = Lamp(
-                device_id=device_id,
-                on=attrs.get("on", False),
-                shade=attrs.get("shade", 100),
-                color=attrs.get("color", "white")
-            )
-            domain_room.add_lamp(domain_device)
-        elif device_type.lower() == "lock":
-            code = attrs.get("code", "0000")
-            domain_device = Lock(
-                device_id=device_id,
-                code=code.split(",") if "," in code else [code],
-                is_unlocked=attrs.get("is_unlocked", False)
-            )
-            domain_room.add_lock(domain_device)
-        elif device_type.lower() == "blinds":
-            domain_device = Blinds(
-                device_id=device_id,
-                is_up=attrs.get("is_up", True),
-                is_open=attrs.get("is_open", False)
-            )
-            domain_room.add_blinds(domain_device)
-        elif device_type.lower() == "ceiling_light":
-            domain_device = CeilingLight(
-                device_id=device_id,
-                on=attrs.get("on", False),
-                shade=attrs.get("shade", 100),
-                color=attrs.get("color", "white")
-            )
-            domain_room.add_ceiling_light(domain_device)
-                
-        # Update device cache
-        domain_room.build_device_cache()
+        # Also update domain model; add_device indexes the new device in place
+        domain_room.add_device(domain_class(device_id=device_id, **domain_kwargs(attrs)))
 
         return {
             "status": "success", 
@@ -597,9 +685,13 @@ def handle_add_device(data, session, user):
             "device_id": device_id
         }
         
-    except Exception as e:
+    except ValueError as e:
         session.rollback()
         return {"status": "error", "message": f"Failed to add device: {str(e)}"}
+    except SQLAlchemyError:
+        session.rollback()
+        logger.exception("Database error trying to add device")
+        return {"status": "error", "message": "Failed to add device: database error"}
 
 def handle_remove_device(data, session, user):
     """Remove a device from a room"""
@@ -611,11 +703,9 @@ def handle_remove_device(data, session, user):
     house = state.get_house(house_id)
     
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
     if not user.can_modify_structure():
         return {"status": "error", "message": "Permission denied."}
 
@@ -636,45 +726,41 @@ def handle_remove_device(data, session, user):
         return {"status": "error", "message": f"Room {room_id} not found."}
 
     # Check if the device exists in the room
-    if device_id not in domain_room.device_map:
+    domain_device = domain_room.device_map.get(device_id)
+    if domain_device is None:
         return {"status": "error", "message": f"Device {device_id} not found in room {room_id}."}
 
     try:
-        # Delete device from the database using ID only
-        deleted = False
-        for orm_class in [LampORM, LockORM, BlindsORM, CeilingLightORM]:
-            device = session.query(orm_class).filter_by(id=device_id).first()
-            if device:
-                session.delete(device)
-                deleted = True
-                break
-
-        if not deleted:
+        # The domain device says which table holds it; delete by the full primary key
+        # (device ids repeat across rooms) in one statement, without loading the row
+        orm_class = DEVICE_MAPPINGS[domain_device.device_type]["orm_class"]
+        result = session.execute(
+            delete(orm_class)
+            .where(orm_class.id == device_id, orm_class.room_id == room_id)
+            .execution_options(synchronize_session=False)
+        )
+
+        if result.rowcount == 0:
+            session.rollback()
             return {"status": "error", "message": f"Device {device_id} not found in database."}
 
         session.commit()
 
-        # Remove from in-memory domain model
-        if device_id in domain_room.lamps:
-            del domain_room.lamps[device_id]
-        elif device_id in domain_room.locks:
-            del domain_room.locks[device_id]
-        elif domain_room.ceiling_light and domain_room.ceiling_light.device_id == device_id:
-            domain_room.ceiling_light = None
-        elif domain_room.blinds and domain_room.blinds.device_id == device_id:
-            domain_room.blinds = None
-
-        # Rebuild device_map
-        domain_room.build_device_cache()
+        # Remove from in-memory domain model and its device caches
+        domain_room.remove_device(device_id)
 
         return {
             "status": "success",
             "message": f"Device {device_id} deleted successfully."
         }
 
-    except Exception as e:
+    except ValueError as e:
         session.rollback()
         return {"status": "error", "message": f"Failed to delete device: {str(e)}"}
+    except SQLAlchemyError:
+        session.rollback()
+        logger.exception("Database error trying to delete device")
+        return {"status": "error", "message": "Failed to delete device: database error"}
 
 def handle_remove_room(data, session, user):
     house_id = data.get("house_id")
@@ -684,11 +770,9 @@ def handle_remove_room(data, session, user):
     house = state.get_house(house_id)
     
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
     if not user.can_modify_structure():
         return {"status": "error", "message": "Permission denied."}
 
@@ -696,18 +780,30 @@ def handle_remove_room(data, session, user):
     if not house:
         return {"status": "error", "message": "House not active in memory."}
 
-    # Find room in DB
-    room_orm = session.query(RoomORM).filter_by(house_id=house_id, id=room_id).first()
-    if not room_orm:
+    # Find room in DB by primary key, then make sure it belongs to this house
+    room_orm = session.get(RoomORM, room_id)
+    if not room_orm or room_orm.house_id != house_id:
         return {"status": "error", "message": f"Room {room_id} not found in database."}
 
     try:
-        # Delete from database — cascades to devices
-        session.delete(room_orm)
+        # Delete the room's devices and then the room with plain DELETEs instead of loading
+        # every device collection for the ORM cascade; SQLite doesn't enforce ON DELETE
+        # CASCADE unless foreign keys are switched on, so the devices are deleted explicitly
+        for orm_class in (LampORM, LockORM, BlindsORM, CeilingLightORM):
+            session.execute(
+                delete(orm_class)
+                .where(orm_class.room_id == room_id)
+                .execution_options(synchronize_session=False)
+            )
+        session.execute(
+            delete(RoomORM)
+            .where(RoomORM.id == room_id)
+            .execution_options(synchronize_session=False)
+        )
         session.commit()
 
         # Remove from domain model
-        room = house.rooms.pop(room_id, None)
+        room = house.remove_room(room_id)
         if room:
             pass
             #this was where the device map thing was i removed
@@ -717,17 +813,19 @@ def handle_remove_room(data, session, user):
             "message": f"Room {room_id} deleted successfully."
         }
 
-    except Exception as e:
+    except ValueError as e:
         session.rollback()
         return {"status": "error", "message": f"Failed to delete room: {str(e)}"}
+    except SQLAlchemyError:
+        session.rollback()
+        logger.exception("Database error trying to delete room")
+        return {"status": "error", "message": "Failed to delete room: database error"}
 
 def handle_set_alarm_threshold(data, house, user):
     # ALARM CHECK - Only allow actions if alarm is not triggered or user is admin
-    if is_alarm_triggered(house) and not user.can_modify_structure():
-        return {
-            "status": "error", 
-            "message": "ALARM TRIGGERED: Only administrators can perform actions until the alarm is deactivated."
-        }
+    error = check_alarm_lockout(house, user)
+    if error:
+        return error
     if not user.can_modify_structure():
         return {"status": "error", "message": "Permission denied"}
 
@@ -753,16 +851,37 @@ def load_house_if_needed(house_id, session):
         house: The domain House object
     """
     house = state.get_house(house_id)
-    if not house:
-        house_row = session.query(House).get(house_id)
+    if house:
+        return house
+    
+    # Clients joining the same house at once share one load; on a timeout load anyway,
+    # add_house still keeps whichever copy was stored first
+    load_lock = state.house_load_lock(house_id)
+    lock_acquired = load_lock.acquire(timeout=state.lock_timeout)
+    if not lock_acquired:
+        logger.warning(f"Timeout waiting for house {house_id} to load, loading it again")
+    try:
+        # Another thread may have finished loading it while this one waited
+        house = state.get_house(house_id)
+        if house:
+            return house
+        
+        # An evicted house may still have device updates queued, land them before reloading
+        device_writer.flush()
+        # Only the columns domain_house_from_orm reads; session.get checks the identity map first
+        house_row = session.get(
+            House, house_id,
+            options=[load_only(House.id, House.name, House.next_device_id), *HOUSE_LOAD_OPTIONS]
+        )
         if not house_row:
             raise ValueError(f"House {house_id} not found in database")
             
-        house = domain_house_from_orm(house_row)
-        state.add_house(house_id, house)
+        house = state.add_house(house_id, domain_house_from_orm(house_row))
         logger.info(f"Loaded house {house_id} into memory")
-    
-    return house
+        return house
+    finally:
+        if lock_acquired:
+            load_lock.release()
 
 def check_user_house_access(user_id, house_id, session):
     """
@@ -776,9 +895,6 @@ def check_user_house_access(user_id, house_id, session):
     Returns:
         role: The user's role for this house, or None if no access
     """
-    house_role = session.query(HouseUserRole).filter_by(
-        user_id=user_id,
-        house_id=house_id
-    ).first()
+    house_role = session.get(HouseUserRole, (user_id, house_id))
     
     return house_role.role if house_role else None
\ No newline at end of file
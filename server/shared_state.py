@@ -2,248 +2,443 @@
 import threading
 import logging
 import time
+from contextlib import contextmanager
+from types import MappingProxyType
 
 # Configure logging
 logger = logging.getLogger("SharedState")
 
+# Bound once for the per-message paths (get_house, _locked) instead of two lookups per call
+_monotonic = time.monotonic
+_get_ident = threading.get_ident
+
+# Number of client shards, must be a power of two
+CLIENT_SHARDS = 16
+
+# Houses kept in memory; past this the least recently used ones without clients are dropped
+MAX_ACTIVE_HOUSES = 256
+
+# Seconds a house with no clients may stay in memory unused
+HOUSE_IDLE_TIMEOUT = 600
+
+# Seconds a cached house role is trusted; roles are changed straight in the database,
+# so this bounds how long a revoked or changed role keeps working for a connected user
+ROLE_CACHE_TTL = 60
+
+# Seconds a SharedState lock may be held before the lock monitor reports it
+LOCK_HOLD_WARNING = 1.0
+
+# Seconds between lock monitor checks
+LOCK_MONITOR_INTERVAL = 0.5
+
+# Per-connection session data, one instance per connected websocket client
+class ClientState:
+    __slots__ = ('user_id', 'username', 'house_id', 'authenticated', 'role', 'domain_user')
+
+    def __init__(self):
+        self.user_id = None
+        self.username = None
+        self.house_id = None
+        self.authenticated = False
+        self.role = None
+        self.domain_user = None  # Domain User for the joined house, rebuilt on join
+
+    def get(self, key, default=None):
+        """Dict-style read for callers written against the old per-client dicts"""
+        return getattr(self, key, default)
+
+class LockTimeout(TimeoutError):
+    """A SharedState lock could not be acquired within lock_timeout"""
+
 # Thread-safe global state for active houses and connected clients
 class SharedState:
+    # Fixed attribute set, looked up on every message
+    __slots__ = (
+        'active_houses', 'house_last_used', 'active_houses_lock',
+        'house_load_locks', 'house_load_locks_lock',
+        'client_shards', 'clients_by_house', 'clients_by_house_lock',
+        'role_cache', 'role_cache_lock',
+        'house_versions', 'house_state_cache', 'house_state_lock',
+        'server',
+        'lock_timeout', 'lock_holders', 'monitor_thread',
+    )
+
     def __init__(self):
-        # Houses in memory
+        # Houses in memory with the time each was last used; adds and removals copy the
+        # dict under the lock and swap it in, so lookups and snapshots read it lock-free
         self.active_houses = {}
+        self.house_last_used = {}
         self.active_houses_lock = threading.Lock()  # Standard lock instead of RLock
         
-        # Connected clients (from websocket_server)
-        self.clients = {}
-        self.clients_lock = threading.Lock()  # Standard lock instead of RLock
+        # One lock per house being loaded, so concurrent misses on the same house
+        # wait for a single database load instead of each running their own
+        self.house_load_locks = {}
+        self.house_load_locks_lock = threading.Lock()
         
-        # Server instance
+        # Connected clients (from websocket_server), sharded by client id so
+        # threads serving unrelated clients don't contend on a single lock
+        self.client_shards = [({}, threading.Lock()) for _ in range(CLIENT_SHARDS)]
+        
+        # Client ids per joined house, kept by add/remove/update_client so house lookups
+        # don't scan every shard; taken after a shard lock, never before one
+        self.clients_by_house = {}
+        self.clients_by_house_lock = threading.Lock()
+        
+        # Cached house roles keyed by (user_id, house_id) -> (role, expiry time)
+        self.role_cache = {}
+        self.role_cache_lock = threading.Lock()
+        
+        # Encoded house state snapshots keyed by house_id -> (version, bytes)
+        self.house_versions = {}
+        self.house_state_cache = {}
+        self.house_state_lock = threading.Lock()
+        
+        # Server instance, set once at startup; a reference assignment is atomic, so
+        # neither set_server nor get_server needs a lock
         self.server = None
-        self.server_lock = threading.Lock()
         
         # Lock timeout in seconds
         self.lock_timeout = 5.0
         
+        # Who holds each lock taken through _locked, keyed by id(lock) ->
+        # (operation, args, thread id, time acquired), for check_for_deadlocks
+        self.lock_holders = {}
+        self.monitor_thread = None
+        
         logger.info("SharedState initialized")
     
-    # House management methods with timeouts and deadlock prevention
-    def get_house(self, house_id):
-        lock_acquired = False
+    @contextmanager
+    def _locked(self, lock, operation, *args):
+        """
+        Hold a lock for the block, raising LockTimeout if it isn't free within lock_timeout
+        
+        operation is a %-format string filled from args, only when the lock times out
+        """
+        if not lock.acquire(timeout=self.lock_timeout):
+            operation = operation % args
+            holder = self.lock_holders.get(id(lock))
+            if holder:
+                logger.warning("Timeout acquiring lock for %s, held by %s in thread %s",
+                               operation, holder[0] % holder[1], holder[2])
+            else:
+                logger.warning("Timeout acquiring lock for %s", operation)
+            raise LockTimeout(f"Timeout acquiring lock for {operation}")
+        # Single dict writes are atomic, so recording the holder needs no lock of its own
+        key = id(lock)
+        self.lock_holders[key] = (operation, args, _get_ident(), _monotonic())
         try:
-            # Try to acquire lock with timeout
-            lock_acquired = self.active_houses_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring houses lock for get_house({house_id})")
-                return None
-                
-            return self.active_houses.get(house_id)
-        except Exception as e:
-            logger.error(f"Error retrieving house {house_id}: {str(e)}")
-            return None
+            yield
         finally:
-            # Only release if we actually acquired the lock
-            if lock_acquired:
-                self.active_houses_lock.release()
+            self.lock_holders.pop(key, None)
+            lock.release()
+    
+    # House management methods with timeouts and deadlock prevention
+    def get_house(self, house_id):
+        # Nearly every message looks its house up, while houses are only added on a cache
+        # miss; a single dict read and write are atomic under the GIL, so the hot path
+        # takes no lock and writers never wait behind readers
+        house = self.active_houses.get(house_id)
+        if house is not None:
+            self.house_last_used[house_id] = _monotonic()
+        return house
     
     def add_house(self, house_id, house):
-        lock_acquired = False
-        try:
-            # Try to acquire lock with timeout
-            lock_acquired = self.active_houses_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring houses lock for add_house({house_id})")
-                raise TimeoutError(f"Timeout adding house {house_id}")
-                
-            self.active_houses[house_id] = house
-            logger.debug(f"House {house_id} added to shared state")
-            return house
-        except Exception as e:
-            logger.error(f"Error adding house {house_id} to shared state: {str(e)}")
-            raise
-        finally:
-            if lock_acquired:
-                self.active_houses_lock.release()
+        """Store a loaded house unless another thread stored one first; returns the house in use"""
+        with self._locked(self.active_houses_lock, "add_house(%s)", house_id):
+            # Two clients can miss the cache and load the same house concurrently;
+            # keep the first copy so every client mutates the same object
+            houses = dict(self.active_houses)
+            house = houses.setdefault(house_id, house)
+            self.house_last_used[house_id] = _monotonic()
+            
+            # Joins index their client under clients_by_house_lock, so holding it while houses
+            # are picked keeps a client from joining one that is about to be evicted
+            evicted = []
+            try:
+                with self._locked(self.clients_by_house_lock, "add_house(%s)", house_id):
+                    evicted = self._evict_houses(houses, self.clients_by_house.keys() | {house_id})
+            except LockTimeout:
+                # Without a complete view of the clients, evicting could drop a house in use
+                pass
+            # Publish the new dict in one assignment; readers keep whichever one they saw
+            self.active_houses = houses
+        
+        # Logging takes its own locks and may do I/O, so it waits until ours is released
+        logger.debug("House %s added to shared state", house_id)
+        if evicted:
+            self._drop_house_state(evicted)
+            logger.info("Evicted %s unused houses from memory", len(evicted))
+        return house
+    
+    def house_load_lock(self, house_id):
+        """Get the lock that serializes loading a house from the database"""
+        with self.house_load_locks_lock:
+            lock = self.house_load_locks.get(house_id)
+            if lock is None:
+                lock = self.house_load_locks[house_id] = threading.Lock()
+            return lock
+    
+    def _evict_houses(self, houses, occupied):
+        """Drop idle houses and, while over capacity, the least recently used ones from an unpublished copy of active_houses"""
+        evicted = []
+        idle_before = _monotonic() - HOUSE_IDLE_TIMEOUT
+        # A lock-free get_house can stamp a house just after it was dropped
+        for house_id in list(self.house_last_used):
+            if house_id in houses:
+                continue
+            self.house_last_used.pop(house_id, None)
+        by_last_use = sorted(houses, key=lambda house_id: self.house_last_used.get(house_id, 0))
+        for house_id in by_last_use:
+            over_capacity = len(houses) > MAX_ACTIVE_HOUSES
+            if not over_capacity and self.house_last_used.get(house_id, 0) > idle_before:
+                # Oldest first, so every house after this one was used more recently
+                break
+            # Clients hold on to their house between messages, never pull it out from under them
+            if house_id in occupied:
+                continue
+            del houses[house_id]
+            self.house_last_used.pop(house_id, None)
+            evicted.append(house_id)
+        return evicted
+    
+    def _drop_house_state(self, house_ids):
+        """Forget the cached state snapshots of evicted houses"""
+        with self.house_state_lock:
+            for house_id in house_ids:
+                self.house_state_cache.pop(house_id, None)
+        with self.house_load_locks_lock:
+            for house_id in house_ids:
+                self.house_load_locks.pop(house_id, None)
     
     def remove_house(self, house_id):
-        lock_acquired = False
-        try:
-            lock_acquired = self.active_houses_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring houses lock for remove_house({house_id})")
-                raise TimeoutError(f"Timeout removing house {house_id}")
-                
-            if house_id in self.active_houses:
-                house = self.active_houses.pop(house_id)
-                logger.debug(f"House {house_id} removed from shared state")
-                return house
-            else:
-                logger.warning(f"Attempted to remove non-existent house {house_id}")
-                return None
-        except Exception as e:
-            logger.error(f"Error removing house {house_id} from shared state: {str(e)}")
-            raise
-        finally:
-            if lock_acquired:
-                self.active_houses_lock.release()
+        with self._locked(self.active_houses_lock, "remove_house(%s)", house_id):
+            houses = dict(self.active_houses)
+            house = houses.pop(house_id, None)
+            if house is not None:
+                self.active_houses = houses
+                self.house_last_used.pop(house_id, None)
+        
+        if house is None:
+            logger.warning("Attempted to remove non-existent house %s", house_id)
+        else:
+            logger.debug("House %s removed from shared state", house_id)
+        return house
     
     def get_all_houses(self):
-        lock_acquired = False
-        try:
-            lock_acquired = self.active_houses_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning("Timeout acquiring houses lock for get_all_houses()")
-                return {}
-                
-            # Return a copy to avoid concurrent modification
-            houses_copy = self.active_houses.copy()
-            return houses_copy
-        except Exception as e:
-            logger.error(f"Error getting all houses: {str(e)}")
-            return {}
-        finally:
-            if lock_acquired:
-                self.active_houses_lock.release()
+        # Writers replace active_houses instead of changing it, so the current dict
+        # is already a consistent snapshot; the proxy keeps callers from editing it
+        return MappingProxyType(self.active_houses)
     
     # Client management methods with timeouts and deadlock prevention
+    def _client_shard(self, client_id):
+        return self.client_shards[client_id & (CLIENT_SHARDS - 1)]
+    
     def get_client(self, client_id):
-        lock_acquired = False
-        try:
-            lock_acquired = self.clients_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring clients lock for get_client({client_id})")
-                return None
-                
-            return self.clients.get(client_id)
-        except Exception as e:
-            logger.error(f"Error retrieving client {client_id}: {str(e)}")
-            return None
-        finally:
-            if lock_acquired:
-                self.clients_lock.release()
+        # Read without the shard lock, like get_house: a single dict read is atomic
+        # under the GIL and writers still serialize on the shard lock
+        clients, _ = self._client_shard(client_id)
+        return clients.get(client_id)
     
     def add_client(self, client_id, client_data):
-        lock_acquired = False
-        try:
-            lock_acquired = self.clients_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring clients lock for add_client({client_id})")
-                raise TimeoutError(f"Timeout adding client {client_id}")
-                
-            self.clients[client_id] = client_data
-            logger.debug(f"Client {client_id} added to shared state")
-        except Exception as e:
-            logger.error(f"Error adding client {client_id} to shared state: {str(e)}")
-            raise
-        finally:
-            if lock_acquired:
-                self.clients_lock.release()
+        clients, lock = self._client_shard(client_id)
+        with self._locked(lock, "add_client(%s)", client_id):
+            clients[client_id] = client_data
+            if client_data.house_id is not None:
+                self._index_client(client_id, None, client_data.house_id)
+        logger.debug("Client %s added to shared state", client_id)
     
     def remove_client(self, client_id):
-        lock_acquired = False
-        try:
-            lock_acquired = self.clients_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring clients lock for remove_client({client_id})")
-                raise TimeoutError(f"Timeout removing client {client_id}")
-                
-            if client_id in self.clients:
-                client_data = self.clients.pop(client_id)
-                logger.debug(f"Client {client_id} removed from shared state")
-                return client_data
-            else:
-                logger.warning(f"Attempted to remove non-existent client {client_id}")
-                return None
-        except Exception as e:
-            logger.error(f"Error removing client {client_id} from shared state: {str(e)}")
-            raise
-        finally:
-            if lock_acquired:
-                self.clients_lock.release()
+        clients, lock = self._client_shard(client_id)
+        with self._locked(lock, "remove_client(%s)", client_id):
+            client_data = clients.pop(client_id, None)
+            if client_data is not None and client_data.house_id is not None:
+                self._index_client(client_id, client_data.house_id, None)
+        
+        if client_data is None:
+            logger.warning("Attempted to remove non-existent client %s", client_id)
+        else:
+            logger.debug("Client %s removed from shared state", client_id)
+        return client_data
     
     def update_client(self, client_id, updates):
-        lock_acquired = False
-        try:
-            lock_acquired = self.clients_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring clients lock for update_client({client_id})")
-                raise TimeoutError(f"Timeout updating client {client_id}")
-                
-            if client_id in self.clients:
-                self.clients[client_id].update(updates)
-                logger.debug(f"Client {client_id} updated in shared state")
-            else:
-                logger.warning(f"Attempted to update non-existent client {client_id}")
-        except Exception as e:
-            logger.error(f"Error updating client {client_id} in shared state: {str(e)}")
-            raise
-        finally:
-            if lock_acquired:
-                self.clients_lock.release()
+        clients, lock = self._client_shard(client_id)
+        with self._locked(lock, "update_client(%s)", client_id):
+            client_data = clients.get(client_id)
+            if client_data is not None:
+                old_house_id = client_data.house_id
+                for key, value in updates.items():
+                    setattr(client_data, key, value)
+                if client_data.house_id != old_house_id:
+                    self._index_client(client_id, old_house_id, client_data.house_id)
+        
+        if client_data is None:
+            logger.warning("Attempted to update non-existent client %s", client_id)
+        else:
+            logger.debug("Client %s updated in shared state", client_id)
+    
+    def _index_client(self, client_id, old_house_id, new_house_id):
+        """Move a client between houses in clients_by_house; call with its shard lock held"""
+        with self.clients_by_house_lock:
+            if old_house_id is not None:
+                client_ids = self.clients_by_house.get(old_house_id)
+                if client_ids is not None:
+                    client_ids.discard(client_id)
+                    if not client_ids:
+                        del self.clients_by_house[old_house_id]
+            if new_house_id is not None:
+                self.clients_by_house.setdefault(new_house_id, set()).add(client_id)
     
     def get_house_clients(self, house_id):
         """Get all clients connected to a specific house"""
-        lock_acquired = False
         try:
-            clients_in_house = {}
-            lock_acquired = self.clients_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning(f"Timeout acquiring clients lock for get_house_clients({house_id})")
-                return {}
-                
-            for client_id, client_data in self.clients.items():
-                if client_data.get('house_id') == house_id:
-                    clients_in_house[client_id] = client_data
-            return clients_in_house
-        except Exception as e:
-            logger.error(f"Error getting clients for house {house_id}: {str(e)}")
+            with self._locked(self.clients_by_house_lock, "get_house_clients(%s)", house_id):
+                client_ids = list(self.clients_by_house.get(house_id, ()))
+        except LockTimeout:
             return {}
-        finally:
-            if lock_acquired:
-                self.clients_lock.release()
+        
+        clients_in_house = {}
+        for client_id in client_ids:
+            client_data = self.get_client(client_id)
+            if client_data is not None:
+                clients_in_house[client_id] = client_data
+        return clients_in_house
     
-    # Server management with timeouts and deadlock prevention
-    def set_server(self, server):
-        lock_acquired = False
+    def count_clients(self):
+        """Count connected clients, holding every shard lock for a consistent snapshot"""
+        acquired = []
         try:
-            lock_acquired = self.server_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning("Timeout acquiring server lock for set_server()")
-                raise TimeoutError("Timeout setting server reference")
+            # Always take shard locks in index order to avoid lock-order deadlocks
+            for clients, lock in self.client_shards:
+                if not lock.acquire(timeout=self.lock_timeout):
+                    logger.warning("Timeout acquiring clients lock for count_clients()")
+                    return None
+                acquired.append(lock)
                 
-            self.server = server
-            logger.debug("Server reference updated in shared state")
-        except Exception as e:
-            logger.error(f"Error setting server reference: {str(e)}")
-            raise
+            return sum(len(clients) for clients, _ in self.client_shards)
         finally:
-            if lock_acquired:
-                self.server_lock.release()
+            for lock in reversed(acquired):
+                lock.release()
     
-    def get_server(self):
-        lock_acquired = False
+    # Role cache management with timeouts and deadlock prevention
+    def get_cached_role(self, user_id, house_id):
+        """Get a user's cached role for a house, or None on a cache miss"""
         try:
-            lock_acquired = self.server_lock.acquire(timeout=self.lock_timeout)
-            if not lock_acquired:
-                logger.warning("Timeout acquiring server lock for get_server()")
+            with self._locked(self.role_cache_lock, "get_cached_role(%s, %s)", user_id, house_id):
+                cached = self.role_cache.get((user_id, house_id))
+                if cached is None:
+                    return None
+                role, expires_at = cached
+                if expires_at <= _monotonic():
+                    # Expired, the caller reads the current role from the database
+                    del self.role_cache[(user_id, house_id)]
+                    return None
+                return role
+        except LockTimeout:
+            # Treated as a miss, the caller falls back to the database
+            return None
+    
+    def cache_role(self, user_id, house_id, role):
+        try:
+            with self._locked(self.role_cache_lock, "cache_role(%s, %s)", user_id, house_id):
+                self.role_cache[(user_id, house_id)] = (role, _monotonic() + ROLE_CACHE_TTL)
+        except LockTimeout:
+            # Skipping the cache only costs a database lookup next time
+            pass
+    
+    def invalidate_role(self, user_id, house_id=None):
+        """Drop a user's cached role for one house, or for every house if house_id is None"""
+        with self._locked(self.role_cache_lock, "invalidate_role(%s, %s)", user_id, house_id):
+            if house_id is not None:
+                self.role_cache.pop((user_id, house_id), None)
+            else:
+                for key in [key for key in self.role_cache if key[0] == user_id]:
+                    del self.role_cache[key]
+    
+    # House state cache, versioned so any mutation invalidates the snapshot
+    def get_house_version(self, house_id):
+        try:
+            with self._locked(self.house_state_lock, "get_house_version(%s)", house_id):
+                return self.house_versions.get(house_id, 0)
+        except LockTimeout:
+            return None
+    
+    def bump_house_version(self, house_id):
+        """Mark a house as changed; call after the mutation has been applied"""
+        try:
+            with self._locked(self.house_state_lock, "bump_house_version(%s)", house_id):
+                self.house_versions[house_id] = self.house_versions.get(house_id, 0) + 1
+                self.house_state_cache.pop(house_id, None)
+        except LockTimeout:
+            # The change is already applied, so it must not turn into an error for the caller;
+            # a single dict pop is atomic, so at least drop the snapshot that is now stale
+            self.house_state_cache.pop(house_id, None)
+            logger.warning("Could not bump version of house %s, its cached state may be stale", house_id)
+    
+    def get_cached_house_state(self, house_id):
+        """Get the encoded state of a house, or None if it changed since it was cached"""
+        try:
+            with self._locked(self.house_state_lock, "get_cached_house_state(%s)", house_id):
+                cached = self.house_state_cache.get(house_id)
+                if cached and cached[0] == self.house_versions.get(house_id, 0):
+                    return cached[1]
                 return None
-                
-            return self.server
-        except Exception as e:
-            logger.error(f"Error retrieving server reference: {str(e)}")
+        except LockTimeout:
             return None
-        finally:
-            if lock_acquired:
-                self.server_lock.release()
+    
+    def cache_house_state(self, house_id, version, payload):
+        """Store an encoded house state built while the house was at the given version"""
+        try:
+            with self._locked(self.house_state_lock, "cache_house_state(%s)", house_id):
+                # A mutation landed while the snapshot was being built, don't cache stale data
+                if version == self.house_versions.get(house_id, 0):
+                    self.house_state_cache[house_id] = (version, payload)
+        except LockTimeout:
+            pass
+    
+    # Server management
+    def set_server(self, server):
+        self.server = server
+        logger.debug("Server reference updated in shared state")
+    
+    def get_server(self):
+        return self.server
                 
-    # Additional method to detect and break potential deadlocks
+    # Lock monitoring, so a stuck lock is reported as it happens instead of only
+    # through the timeouts of every caller queued behind it
     def check_for_deadlocks(self):
         """
-        Check if any locks have been held for too long and log warnings.
-        This could be called from a monitoring thread.
+        Log every lock taken through _locked that has been held for longer than
+        LOCK_HOLD_WARNING seconds.
+        
+        Returns:
+            list: (operation, thread id, seconds held) for each of those locks
         """
-        # In a production system, you might track lock acquisition times
-        # and use this method to detect and potentially break deadlocks
-        pass
+        now = _monotonic()
+        stalled = []
+        for operation, args, thread_id, acquired_at in list(self.lock_holders.values()):
+            held = now - acquired_at
+            if held > LOCK_HOLD_WARNING:
+                stalled.append((operation % args, thread_id, held))
+        
+        for operation, thread_id, held in stalled:
+            logger.warning("Lock for %s held by thread %s for %.1fs", operation, thread_id, held)
+        return stalled
+    
+    def start_lock_monitor(self, interval=LOCK_MONITOR_INTERVAL):
+        """Run check_for_deadlocks every interval seconds on a daemon thread"""
+        if self.monitor_thread is not None:
+            return
+        
+        def monitor():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_for_deadlocks()
+                except Exception:
+                    logger.exception("Lock monitor check failed")
+        
+        self.monitor_thread = threading.Thread(target=monitor, name="lock-monitor", daemon=True)
+        self.monitor_thread.start()
 
 # Create a singleton instance
 state = SharedState()
\ No newline at end of file
@@ -0,0 +1,159 @@
+# server/write_batcher.py
+import logging
+import threading
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, ProgrammingError, DataError
+from db.setup import engine
+
+# Configure logging
+logger = logging.getLogger("WriteBatcher")
+
+# Write-behind queue for device state: actions update the in-memory house right away,
+# and the database catches up in batched UPDATEs from a background thread
+class DeviceWriteBatcher:
+    def __init__(self, flush_interval=0.02, max_batch=256, max_attempts=5):
+        # Latest column values per row, keyed by (orm_class, primary key)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        # Failed flushes in a row; a batch that keeps failing is dropped after max_attempts
+        self.max_attempts = max_attempts
+        self.failures = 0
+
+        # Serializes flushes between the writer thread and explicit flush() calls
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+        # Compiled UPDATE per (orm_class, columns), reused across flushes
+        self.statements = {}
+
+        # Connection kept across flushes, so a flush skips the pool checkout and the
+        # pre-ping that comes with it; only used while holding flush_lock
+        self.connection = None
+
+    def submit(self, orm_class, mapping):
+        """
+        Queue a row update; a later update to the same row replaces this one
+
+        Args:
+            orm_class: ORM class of the row
+            mapping: Column values including every primary key column
+        """
+        key = (orm_class, tuple(mapping[col.key] for col in orm_class.__mapper__.primary_key))
+        with self.pending_lock:
+            self.pending[key] = mapping
+            backlog = len(self.pending)
+
+        self._ensure_started()
+        if backlog >= self.max_batch:
+            self.wakeup.set()
+
+    def _ensure_started(self):
+        if self.running:
+            return
+        with self.thread_lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name="device-writer", daemon=True)
+            self.thread.start()
+            logger.info("Device write batcher started")
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # The writer thread must outlive any single flush, or pending grows forever
+                logger.exception("Device writer flush failed")
+
+    def flush(self):
+        """Write every pending update in one transaction"""
+        with self.flush_lock:
+            with self.pending_lock:
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, {}
+
+            by_class = {}
+            for (orm_class, _), mapping in batch.items():
+                by_class.setdefault(orm_class, []).append(mapping)
+
+            try:
+                if self.connection is None:
+                    self.connection = engine.connect()
+                with self.connection.begin():
+                    for orm_class, mappings in by_class.items():
+                        statement, pk_keys = self._update_statement(orm_class, tuple(mappings[0]))
+                        params = [
+                            {(f"pk_{key}" if key in pk_keys else key): value for key, value in mapping.items()}
+                            for mapping in mappings
+                        ]
+                        # Core executemany: unlike the ORM bulk paths, a row deleted since it was
+                        # queued just matches nothing instead of failing the whole batch
+                        self.connection.execute(statement, params)
+                self.failures = 0
+                logger.debug("Flushed %s device updates", len(batch))
+            except SQLAlchemyError as e:
+                # The transaction was rolled back; drop the connection too in case it broke,
+                # the next flush checks out a fresh one
+                self._close_connection()
+                self.failures += 1
+
+                # These won't succeed on a retry; everything else (a locked database, a busy
+                # timeout, a pool timeout) usually clears up by the next flush
+                permanent = isinstance(e, (IntegrityError, ProgrammingError, DataError))
+                if permanent or self.failures >= self.max_attempts:
+                    self.failures = 0
+                    logger.exception(f"Dropping {len(batch)} device updates that failed to write")
+                    return
+
+                # Put the batch back without overwriting anything submitted since it was taken
+                with self.pending_lock:
+                    for key, mapping in batch.items():
+                        self.pending.setdefault(key, mapping)
+                logger.warning(f"Failed to write {len(batch)} device updates, retrying: {str(e)}")
+
+    def _close_connection(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except SQLAlchemyError:
+                logger.exception("Error closing device writer connection")
+
+    def _update_statement(self, orm_class, columns):
+        key = (orm_class, columns)
+        cached = self.statements.get(key)
+        if cached is None:
+            table = orm_class.__table__
+            pk_keys = {col.key for col in orm_class.__mapper__.primary_key}
+            statement = table.update().where(
+                *[table.c[pk] == bindparam(f"pk_{pk}") for pk in pk_keys]
+            ).values({col: bindparam(col) for col in columns if col not in pk_keys})
+            cached = self.statements[key] = (statement, pk_keys)
+        return cached
+
+    def stop(self):
+        """Stop the writer thread and write whatever is still pending"""
+        with self.thread_lock:
+            self.running = False
+            thread = self.thread
+            self.thread = None
+        self.wakeup.set()
+        if thread:
+            thread.join(timeout=5)
+        self.flush()
+        with self.flush_lock:
+            self._close_connection()
+
+# Create a singleton instance
+device_writer = DeviceWriteBatcher()
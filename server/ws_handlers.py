@@ -0,0 +1,594 @@
+# server/ws_handlers.py
+# Websocket command handlers; full_server accepts connections and dispatches to COMMAND_HANDLERS
+import logging
+import orjson
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from db.setup import SessionLocal
+from model.db import User, House, HouseUserRole
+from model.domain import User as DomainUser
+
+from server.shared_state import state
+from server.auth import verify_password, needs_rehash, rehash_password
+from server.broadcast import register_client, unregister_client, broadcast_to_house
+from server.broadcast import encode_text_frame, queue_frame
+from server.handlers import get_house_state, get_room_state, load_house_if_needed
+from server.handlers import handle_device_action, handle_device_status
+from server.handlers import handle_device_group_status, handle_device_group_action
+from server.handlers import handle_list_house_devices, handle_list_room_devices, handle_list_group_devices
+from server.handlers import handle_add_room as handler_add_room, handle_add_device as handler_add_device
+from server.handlers import handle_remove_room as handler_remove_room, handle_remove_device as handler_remove_device
+
+# Configure logging
+logger = logging.getLogger('WebSocketServer')
+
+# Fixed error responses, encoded once at import instead of on every rejection
+PRECOMPUTED_ERRORS = {
+    message: orjson.dumps({"type": "error", "message": message})
+    for message in (
+        "Not authenticated",
+        "Not currently in a house",
+        "House data not loaded",
+        "Access denied to this house",
+        "House ID is required",
+        "Room ID is required",
+        "Device type is required",
+        "Username and password are required",
+        "Invalid username or password",
+        "Invalid JSON format",
+        "Message too large",
+        "Database error",
+        "Bad request",
+        "Internal server error",
+    )
+}
+
+def send_json(client, server, obj):
+    """Serialize a response once and queue it on the client's outbox"""
+    # Room and device ids are int dict keys, which json.dumps used to coerce to strings
+    payload = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    queue_frame(client, encode_text_frame(payload), payload, block=True)
+
+def send_error(client, server, message):
+    """Send error response to client"""
+    payload = PRECOMPUTED_ERRORS.get(message)
+    if payload is None:
+        payload = orjson.dumps({
+            "type": "error",
+            "message": message
+        })
+    queue_frame(client, encode_text_frame(payload), payload, block=True)
+    logger.warning(f"Error sent to client {client['id']}: {message}")
+
+def handle_login(client, server, data):
+    """Process login request"""
+    client_id = client['id']
+    username = data.get('username')
+    password = data.get('password')
+    
+    if not username or not password:
+        send_error(client, server, "Username and password are required")
+        return
+    
+    with SessionLocal() as session:
+        try:
+            # Find user
+            user = session.query(User).filter_by(username=username).first()
+        
+            # Verify on the bounded hashing pool; an unknown user still pays for a hash
+            if not verify_password(password, user.password_hash if user else None):
+                send_error(client, server, "Invalid username or password")
+                return
+            
+            # Migrate plain text rows and older scrypt parameters now that the password is known
+            if needs_rehash(user.password_hash):
+                user.password_hash = rehash_password(password)
+                session.commit()
+                logger.info(f"Upgraded password hash for user {user.id}")
+        
+            # Get houses this user has access to
+            # Plain column tuples, no House instances are hydrated just to read id/name
+            house_rows = session.execute(
+                select(House.id, House.name, HouseUserRole.role)
+                .join(HouseUserRole, HouseUserRole.house_id == House.id)
+                .where(HouseUserRole.user_id == user.id)
+            ).all()
+        
+            houses_info = [
+                {
+                    "id": row.id, 
+                    "name": row.name, 
+                    "role": row.role
+                }
+                for row in house_rows
+            ]
+            
+            # Refresh the role cache so join_house doesn't need to query roles again
+            state.invalidate_role(user.id)
+            for row in house_rows:
+                state.cache_role(user.id, row.id, row.role)
+        
+            # Update client tracking info using shared state
+            state.update_client(client_id, {
+                'user_id': user.id,
+                'username': user.username,
+                'authenticated': True,
+                'house_id': None,  # Will be set when they join a house
+                'role': None,
+                'domain_user': None
+            })
+        
+            # Send login success response
+            response = {
+                "type": "login_response",
+                "status": "success",
+                "user_id": user.id,
+                "username": user.username,
+                "houses": houses_info
+            }
+        
+            send_json(client, server, response)
+            logger.info(f"User {username} logged in successfully")
+    
+        except SQLAlchemyError:
+            # Don't leak database details to the client
+            logger.exception("Database error during login")
+            send_error(client, server, "Login failed")
+
+def send_house_state(client, house, response):
+    """
+    Send a house_state response, reusing the encoded house state while the house is unchanged
+    
+    Args:
+        client: WebSocket client object
+        house: Domain SmartHouse
+        response: Envelope fields to send alongside the state
+    """
+    house_id = house.house_id
+    state_json = state.get_cached_house_state(house_id)
+    if state_json is None:
+        # Read the version first so a mutation during the walk leaves the snapshot uncached
+        version = state.get_house_version(house_id)
+        state_json = orjson.dumps(get_house_state(house), option=orjson.OPT_NON_STR_KEYS)
+        if version is not None:
+            state.cache_house_state(house_id, version, state_json)
+    
+    # Splice the cached state into the envelope instead of re-encoding it
+    payload = orjson.dumps(response)[:-1] + b',"state":' + state_json + b'}'
+    queue_frame(client, encode_text_frame(payload), payload, block=True)
+
+def get_client_context(client, server, require_house=True):
+    """
+    Run the checks shared by every handler that acts on the client's session.
+    Sends the matching error to the client when a check fails.
+    
+    Args:
+        client: WebSocket client object
+        server: WebsocketServer instance
+        require_house: Whether the client must have joined a loaded house
+        
+    Returns:
+        (client_data, house, user) tuple, or None if the request was rejected.
+        house and user are None when require_house is False.
+    """
+    client_data = state.get_client(client['id'])
+    if not client_data or not client_data.authenticated:
+        send_error(client, server, "Not authenticated")
+        return None
+    
+    if not require_house:
+        return client_data, None, None
+    
+    house_id = client_data.house_id
+    if not house_id:
+        send_error(client, server, "Not currently in a house")
+        return None
+    
+    # Get house from shared state
+    house = state.get_house(house_id)
+    if not house:
+        # Eviction skips houses with clients, but can race a join that is still in progress
+        with SessionLocal() as session:
+            try:
+                house = load_house_if_needed(house_id, session)
+            except ValueError:
+                house = None
+    if not house:
+        send_error(client, server, "House data not loaded")
+        return None
+    
+    # Domain user is cached on the client when it joins the house
+    user = client_data.domain_user
+    if user is None:
+        user = DomainUser(
+            user_id=client_data.user_id, 
+            username=client_data.username, 
+            role=client_data.role
+        )
+    
+    return client_data, house, user
+
+def handle_join_house(client, server, data):
+    """Process request to join a house"""
+    client_id = client['id']
+    
+    context = get_client_context(client, server, require_house=False)
+    if context is None:
+        return
+    client_data = context[0]
+    
+    house_id = data.get('house_id')
+    if not house_id:
+        send_error(client, server, "House ID is required")
+        return
+    
+    with SessionLocal() as session:
+        try:
+            # Check if user has access to this house, using the role cached at login if present
+            user_id = client_data.user_id
+            role = state.get_cached_role(user_id, house_id)
+            if role is None:
+                house_role = session.get(HouseUserRole, (user_id, house_id))
+        
+                if not house_role:
+                    send_error(client, server, "Access denied to this house")
+                    return
+                
+                role = house_role.role
+                state.cache_role(user_id, house_id, role)
+        
+            # Load the house before switching the client to it, so a missing house leaves
+            # the client in its current house
+            try:
+                house = load_house_if_needed(house_id, session)
+            except ValueError:
+                send_error(client, server, "House not found")
+                return
+        
+            # If client was in another house, remove them
+            old_house_id = client_data.house_id
+            if old_house_id:
+                unregister_client(old_house_id, client)
+        
+            # Update client's current house using shared state
+            # Build the domain user once per join instead of on every message
+            state.update_client(client_id, {
+                'house_id': house_id,
+                'role': role,
+                'domain_user': DomainUser(
+                    user_id=client_data.user_id,
+                    username=client_data.username,
+                    role=role
+                )
+            })
+        
+            # Register client for broadcasts to this house before the state snapshot is taken
+            register_client(house_id, client)
+        
+            # Eviction skips houses with clients, but the house could have gone between loading
+            # it and the client joining; now that it can't, make sure this is the copy in use
+            house = load_house_if_needed(house_id, session)
+        
+            # Send house joined response with initial state
+            response = {
+                "type": "house_state",
+                "status": "success",
+                "house_id": house_id,
+                "name": house.name
+            }
+        
+            send_house_state(client, house, response)
+            logger.info(f"Client {client_id} joined house {house_id}")
+        
+        except SQLAlchemyError:
+            logger.exception("Database error joining house")
+            send_error(client, server, "Failed to join house")
+
+def handle_logout(client, server, data):
+    """Process logout request"""
+    client_id = client['id']
+    
+    # Get client data from shared state
+    client_data = state.get_client(client_id)
+    if not client_data:
+        return
+    
+    # Get house_id before resetting
+    house_id = client_data.house_id
+    
+    # Reset client state using shared state
+    state.update_client(client_id, {
+        'user_id': None,
+        'username': None,
+        'house_id': None,
+        'authenticated': False,
+        'role': None,
+        'domain_user': None
+    })
+    
+    # Unregister from broadcasts if in a house
+    if house_id:
+        unregister_client(house_id, client)
+    
+    # Send logout confirmation
+    response = {
+        "type": "logout_response",
+        "status": "success"
+    }
+    send_json(client, server, response)
+    logger.info(f"Client {client_id} logged out")
+
+def handle_device_action_message(client, server, data):
+    """Process device control request"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    with SessionLocal() as session:
+        # Pass the client ID to the handler; it bumps the house version itself,
+        # before broadcasting, whenever the action changed something
+        result = handle_device_action(house, user, session, data, client_id=client['id'])
+        send_json(client, server, result)
+
+def handle_device_status_message(client, server, data):
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+
+    result = handle_device_status(data, house, user)
+    send_json(client, server, result)
+
+def handle_query_house(client, server, data):
+    """Process request to query entire house state"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    response = {
+        "type": "house_state",
+        "status": "success",
+        "house_id": client_data.house_id
+    }
+    
+    send_house_state(client, house, response)
+
+def handle_query_room(client, server, data):
+    """Process request to query a room's state"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    room_id = data.get('room_id')
+    if not room_id:
+        send_error(client, server, "Room ID is required")
+        return
+    
+    room = house.rooms.get(room_id)
+    if not room:
+        send_error(client, server, f"Room {room_id} not found")
+        return
+    
+    room_state = get_room_state(room)
+    
+    response = {
+        "type": "room_state",
+        "status": "success",
+        "room_id": room_id,
+        "state": room_state
+    }
+    
+    send_json(client, server, response)
+
+def handle_device_group_status_message(client, server, data):
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    result = handle_device_group_status(data, house, user)
+    send_json(client, server, result)
+
+
+def handle_device_group_action_message(client, server, data):
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    with SessionLocal() as session:
+        # The handler bumps the house version itself before broadcasting
+        result = handle_device_group_action(house, user, session, data)
+        send_json(client, server, result)
+
+def handle_list_house_devices_message(client, server, data):
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    result = handle_list_house_devices(house, user)
+    send_json(client, server, result)
+
+
+def handle_add_room(client, server, data):
+    """Process request to add a new room"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    house_id = client_data.house_id
+    
+    with SessionLocal() as session:
+        # Add house_id to the data
+        data['house_id'] = house_id
+    
+        # Call the handler
+        result = handler_add_room(data, session, user)
+        if result.get('status') == 'success':
+            # Invalidate the cached house state before anyone hears about the change
+            state.bump_house_version(house_id)
+        send_json(client, server, result)
+    
+        # Broadcast room addition to other clients if successful
+        if result.get('status') == 'success':
+            broadcast_message = {
+                "type": "room_added",
+                "house_id": house_id,
+                "room_id": result.get('room_id'),
+                "room_name": data.get('room_name', "New Room")
+            }
+            broadcast_to_house(house_id, broadcast_message, exclude_client_id=client['id'])
+            logger.info("Room %s added and broadcasted to house %s", result.get('room_id'), house_id)
+
+def handle_add_device(client, server, data):
+    """Process request to add a new device"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    house_id = client_data.house_id
+    
+    with SessionLocal() as session:
+        # Add house_id to the data
+        data['house_id'] = house_id
+    
+        # Call the handler
+        result = handler_add_device(data, session, user)
+        if result.get('status') == 'success':
+            # Invalidate the cached house state before anyone hears about the change
+            state.bump_house_version(house_id)
+        send_json(client, server, result)
+    
+        # Broadcast device addition to other clients if successful
+        if result.get('status') == 'success':
+            broadcast_message = {
+                "type": "device_added",
+                "house_id": house_id,
+                "room_id": data.get('room_id'),
+                "device_id": result.get('device_id'),
+                "device_type": data.get('device_type')
+            }
+            broadcast_to_house(house_id, broadcast_message, exclude_client_id=client['id'])
+            logger.info("Device %s added and broadcasted to house %s", result.get('device_id'), house_id)
+
+def handle_remove_room(client, server, data):
+    """Process request to remove a room"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    house_id = client_data.house_id
+    
+    # Store room_id for broadcasting before it might be removed from result
+    room_id = data.get('room_id')
+    
+    with SessionLocal() as session:
+        # Add house_id to the data
+        data['house_id'] = house_id
+    
+        # Call the handler
+        result = handler_remove_room(data, session, user)
+        if result.get('status') == 'success':
+            # Invalidate the cached house state before anyone hears about the change
+            state.bump_house_version(house_id)
+        send_json(client, server, result)
+    
+        # Broadcast room removal to other clients if successful
+        if result.get('status') == 'success':
+            broadcast_message = {
+                "type": "room_removed",
+                "house_id": house_id,
+                "room_id": room_id
+            }
+            broadcast_to_house(house_id, broadcast_message, exclude_client_id=client['id'])
+            logger.info("Room %s removed and broadcasted to house %s", room_id, house_id)
+
+
+def handle_remove_device(client, server, data):
+    """Process request to remove a device"""
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    house_id = client_data.house_id
+    
+    # Store these for broadcasting before they might be removed from result
+    room_id = data.get('room_id')
+    device_id = data.get('device_id')
+    
+    with SessionLocal() as session:
+        # Add house_id to the data
+        data['house_id'] = house_id
+    
+        # Call the handler
+        result = handler_remove_device(data, session, user)
+        if result.get('status') == 'success':
+            # Invalidate the cached house state before anyone hears about the change
+            state.bump_house_version(house_id)
+        send_json(client, server, result)
+    
+        # Broadcast device removal to other clients if successful
+        if result.get('status') == 'success':
+            broadcast_message = {
+                "type": "device_removed",
+                "house_id": house_id,
+                "room_id": room_id,
+                "device_id": device_id
+            }
+            broadcast_to_house(house_id, broadcast_message, exclude_client_id=client['id'])
+            logger.info("Device %s removed and broadcasted to house %s", device_id, house_id)
+
+
+def handle_list_room_devices_message(client, server, data):
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    room_id = data.get('room_id')
+    if not room_id:
+        send_error(client, server, "Room ID is required")
+        return
+    
+    result = handle_list_room_devices(house, user, room_id)
+    send_json(client, server, result)
+
+def handle_list_group_devices_message(client, server, data):
+    context = get_client_context(client, server)
+    if context is None:
+        return
+    client_data, house, user = context
+    
+    device_type = data.get('device_type')
+    if not device_type:
+        send_error(client, server, "Device type is required")
+        return
+    
+    result = handle_list_group_devices(house, user, device_type)
+    send_json(client, server, result)
+
+# Map each client command to the function that handles it
+COMMAND_HANDLERS = {
+    'login': handle_login,
+    'join_house': handle_join_house,
+    'logout': handle_logout,
+    'device_action': handle_device_action_message,
+    'device_group_action': handle_device_group_action_message,
+    'query_house': handle_query_house,
+    'query_room': handle_query_room,
+    'device_status': handle_device_status_message,
+    'device_group_status': handle_device_group_status_message,
+    'list_house_devices': handle_list_house_devices_message,
+    'list_room_devices': handle_list_room_devices_message,
+    'list_group_devices': handle_list_group_devices_message,
+    'add_room': handle_add_room,
+    'add_device': handle_add_device,
+    'remove_room': handle_remove_room,
+    'remove_device': handle_remove_device
+}
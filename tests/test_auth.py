@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+
+from server import auth
+from server.auth import hash_password, verify_password, needs_rehash, rehash_password
+
+class PasswordHashTest(unittest.TestCase):
+    def test_round_trip(self):
+        stored = hash_password("correct horse")
+        
+        self.assertTrue(stored.startswith(f"{auth.HASH_PREFIX}$"))
+        self.assertNotIn("correct horse", stored)
+        self.assertTrue(verify_password("correct horse", stored))
+        self.assertFalse(needs_rehash(stored))
+    
+    def test_salted(self):
+        self.assertNotEqual(hash_password("correct horse"), hash_password("correct horse"))
+    
+    def test_wrong_password(self):
+        stored = hash_password("correct horse")
+        
+        self.assertFalse(verify_password("battery staple", stored))
+    
+    def test_unknown_user(self):
+        # Runs against the dummy hash, so even the password it was made from can't match
+        with mock.patch.object(auth, "_verify", wraps=auth._verify) as verify:
+            self.assertFalse(verify_password("correct horse", None))
+        verify.assert_called_once_with("correct horse", auth._DUMMY_HASH)
+    
+    def test_plain_text_row(self):
+        self.assertTrue(verify_password("password1", "password1"))
+        self.assertFalse(verify_password("password2", "password1"))
+        self.assertTrue(needs_rehash("password1"))
+        
+        upgraded = rehash_password("password1")
+        self.assertFalse(needs_rehash(upgraded))
+        self.assertTrue(verify_password("password1", upgraded))
+    
+    def test_older_parameters(self):
+        with mock.patch.object(auth, "SCRYPT_N", 2 ** 10):
+            stored = hash_password("correct horse")
+        
+        # Still verifies with the parameters it was made with, but gets upgraded
+        self.assertTrue(verify_password("correct horse", stored))
+        self.assertTrue(needs_rehash(stored))
+
+if __name__ == "__main__":
+    unittest.main()
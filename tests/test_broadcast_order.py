@@ -0,0 +1,101 @@
+import queue
+import time
+import unittest
+
+import orjson
+
+from server import broadcast
+from server.shared_state import state
+
+HOUSE_ID = 1
+
+def make_client(client_id):
+    """Fake websocket client whose frames stay on its outbox"""
+    return {'id': client_id, 'handler': None, 'outbox': queue.Queue()}
+
+def received(client):
+    """Decode every message waiting on a client's outbox, in order"""
+    messages = []
+    while True:
+        try:
+            header, payload = client['outbox'].get_nowait()
+        except queue.Empty:
+            return messages
+        messages.append(orjson.loads(payload))
+
+class BroadcastOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_server = state.get_server()
+        state.set_server(object())
+        self.sender = make_client(1)
+        self.peer = make_client(2)
+        broadcast.register_client(HOUSE_ID, self.sender)
+        broadcast.register_client(HOUSE_ID, self.peer)
+    
+    def tearDown(self):
+        broadcast.unregister_client(HOUSE_ID, self.sender)
+        broadcast.unregister_client(HOUSE_ID, self.peer)
+        broadcast._send_pending(HOUSE_ID)
+        broadcast._send_locks.pop(HOUSE_ID, None)
+        state.set_server(self.previous_server)
+    
+    def test_pending_update_is_sent_before_immediate_broadcast(self):
+        update = {"type": "device_update", "room_id": 3, "device_id": 7, "state": {"on": True}}
+        removed = {"type": "device_removed", "room_id": 3, "device_id": 7}
+        
+        broadcast.coalesce_to_house(HOUSE_ID, update, exclude_client_id=self.sender['id'])
+        broadcast.broadcast_to_house(HOUSE_ID, removed, exclude_client_id=self.sender['id'])
+        
+        self.assertEqual(received(self.peer), [update, removed])
+        self.assertEqual(received(self.sender), [])
+    
+    def test_batched_updates_keep_their_place(self):
+        first = {"type": "device_update", "room_id": 3, "device_id": 7, "state": {"on": True}}
+        second = {"type": "device_update", "room_id": 3, "device_id": 8, "state": {"on": False}}
+        alarm = {"type": "alarm_triggered", "house_id": HOUSE_ID}
+        
+        broadcast.coalesce_to_house(HOUSE_ID, first)
+        broadcast.coalesce_to_house(HOUSE_ID, second)
+        broadcast.broadcast_to_house(HOUSE_ID, alarm)
+        
+        expected = [{"type": "batch_update", "events": [first, second]}, alarm]
+        self.assertEqual(received(self.peer), expected)
+        self.assertEqual(received(self.sender), expected)
+    
+    def test_window_timer_does_not_resend_flushed_updates(self):
+        update = {"type": "device_update", "room_id": 3, "device_id": 7, "state": {"brightness": 40}}
+        group = {"type": "group_update", "group_id": 2}
+        
+        broadcast.coalesce_to_house(HOUSE_ID, update)
+        broadcast.broadcast_to_house(HOUSE_ID, group)
+        time.sleep(broadcast.COALESCE_WINDOW * 3)
+        
+        self.assertEqual(received(self.peer), [update, group])
+
+    def test_send_lock_dropped_with_last_subscriber(self):
+        broadcast.broadcast_to_house(HOUSE_ID, {"type": "group_update", "group_id": 2})
+        self.assertIn(HOUSE_ID, broadcast._send_locks)
+        
+        broadcast.unregister_client(HOUSE_ID, self.sender)
+        self.assertIn(HOUSE_ID, broadcast._send_locks)
+        broadcast.unregister_client(HOUSE_ID, self.peer)
+        self.assertNotIn(HOUSE_ID, broadcast._send_locks)
+        
+        # Broadcasting to the empty house doesn't bring it back
+        broadcast.broadcast_to_house(HOUSE_ID, {"type": "group_update", "group_id": 2})
+        self.assertNotIn(HOUSE_ID, broadcast._send_locks)
+    
+    def test_send_lock_kept_while_updates_pending(self):
+        broadcast.broadcast_to_house(HOUSE_ID, {"type": "group_update", "group_id": 2})
+        broadcast.coalesce_to_house(HOUSE_ID, {"type": "device_update", "room_id": 3, "device_id": 7})
+        
+        broadcast.unregister_client(HOUSE_ID, self.sender)
+        broadcast.unregister_client(HOUSE_ID, self.peer)
+        self.assertIn(HOUSE_ID, broadcast._send_locks)
+        
+        # The window's flush finds the house empty and lets the lock go
+        time.sleep(broadcast.COALESCE_WINDOW * 3)
+        self.assertNotIn(HOUSE_ID, broadcast._send_locks)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from server import shared_state
+from server.shared_state import SharedState, ClientState
+
+def joined_client(house_id):
+    client = ClientState()
+    client.house_id = house_id
+    return client
+
+class HouseEvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.state = SharedState()
+        patcher = mock.patch.object(shared_state, "MAX_ACTIVE_HOUSES", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def add_houses(self, *house_ids):
+        now = time.monotonic()
+        for house_id in house_ids:
+            self.state.add_house(house_id, object())
+            # Recent but distinct last-use times, oldest first
+            self.state.house_last_used[house_id] = now - 10 + house_id
+    
+    def test_least_recently_used_house_is_evicted(self):
+        self.add_houses(1, 2)
+        self.state.add_house(3, object())
+        
+        self.assertEqual(sorted(self.state.get_all_houses()), [2, 3])
+    
+    def test_occupied_house_is_not_evicted(self):
+        self.add_houses(1, 2)
+        self.state.add_client(10, joined_client(1))
+        
+        self.state.add_house(3, object())
+        
+        self.assertEqual(sorted(self.state.get_all_houses()), [1, 3])
+    
+    def test_no_eviction_while_clients_index_is_busy(self):
+        self.add_houses(1, 2)
+        self.state.lock_timeout = 0.05
+        
+        # A join in progress holds the clients index; add_house can't tell which houses are
+        # occupied, so it must keep them all rather than guess
+        with self.state.clients_by_house_lock:
+            self.state.add_house(3, object())
+        
+        self.assertEqual(sorted(self.state.get_all_houses()), [1, 2, 3])
+
+    def test_join_while_add_house_waits_is_counted_as_occupied(self):
+        self.add_houses(1, 2)
+        self.state.add_client(10, ClientState())
+        
+        # add_house waits for the houses lock while a client joins the least recently used house
+        with self.state.active_houses_lock:
+            adder = threading.Thread(target=self.state.add_house, args=(3, object()))
+            adder.start()
+            time.sleep(0.1)
+            self.state.update_client(10, {'house_id': 1})
+        adder.join()
+        
+        self.assertEqual(sorted(self.state.get_all_houses()), [1, 3])
+
+if __name__ == "__main__":
+    unittest.main()
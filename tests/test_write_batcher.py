@@ -0,0 +1,94 @@
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.pool import StaticPool
+
+from model.db import Base, Lamp
+from server import write_batcher
+from server.write_batcher import DeviceWriteBatcher
+
+def locked_error():
+    return OperationalError("UPDATE lamps", {}, Exception("database is locked"))
+
+class DeviceWriteBatcherTest(unittest.TestCase):
+    def setUp(self):
+        # One in-memory database shared by every connection the batcher opens
+        self.engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        Base.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(Lamp.__table__.insert(), [
+                {"id": 1, "room_id": 1, "on": False, "shade": 100, "color": "white"},
+                {"id": 2, "room_id": 1, "on": False, "shade": 100, "color": "white"},
+            ])
+        
+        patcher = mock.patch.object(write_batcher, "engine", self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+        self.writer = DeviceWriteBatcher(max_attempts=3)
+        # Flushes are driven by the test, not the background thread
+        self.writer.running = True
+        self.addCleanup(self.writer._close_connection)
+    
+    def lamps(self):
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(Lamp.id, Lamp.on, Lamp.shade).order_by(Lamp.id))
+            return [tuple(row) for row in rows]
+    
+    def fail_next_connect(self, error):
+        connect = self.engine.connect
+        calls = []
+        def failing_connect():
+            if not calls:
+                calls.append(error)
+                raise error
+            return connect()
+        return mock.patch.object(self.engine, "connect", side_effect=failing_connect)
+    
+    def test_transient_failure_is_written_on_next_flush(self):
+        self.writer.submit(Lamp, {"id": 1, "room_id": 1, "on": True, "shade": 40})
+        self.writer.submit(Lamp, {"id": 2, "room_id": 1, "on": True, "shade": 70})
+        
+        with self.fail_next_connect(locked_error()):
+            self.writer.flush()
+            self.assertEqual(self.lamps(), [(1, False, 100), (2, False, 100)])
+            self.writer.flush()
+        
+        self.assertEqual(self.lamps(), [(1, True, 40), (2, True, 70)])
+        self.assertEqual(self.writer.pending, {})
+    
+    def test_retry_keeps_newer_updates(self):
+        self.writer.submit(Lamp, {"id": 1, "room_id": 1, "on": True, "shade": 40})
+        
+        with self.fail_next_connect(locked_error()):
+            self.writer.flush()
+            # Submitted after the failed batch was taken, so it must win over the retried one
+            self.writer.submit(Lamp, {"id": 1, "room_id": 1, "on": False, "shade": 10})
+            self.writer.flush()
+        
+        self.assertEqual(self.lamps(), [(1, False, 10), (2, False, 100)])
+    
+    def test_permanent_failure_drops_batch(self):
+        self.writer.submit(Lamp, {"id": 1, "room_id": 1, "on": True, "shade": 40})
+        
+        error = IntegrityError("UPDATE lamps", {}, Exception("constraint failed"))
+        with self.fail_next_connect(error):
+            self.writer.flush()
+        
+        self.assertEqual(self.writer.pending, {})
+        self.assertEqual(self.lamps(), [(1, False, 100), (2, False, 100)])
+    
+    def test_batch_dropped_after_max_attempts(self):
+        self.writer.submit(Lamp, {"id": 1, "room_id": 1, "on": True, "shade": 40})
+        
+        with mock.patch.object(self.engine, "connect", side_effect=locked_error()):
+            for _ in range(self.writer.max_attempts):
+                self.writer.flush()
+        
+        self.assertEqual(self.writer.pending, {})
+        self.assertEqual(self.lamps(), [(1, False, 100), (2, False, 100)])
+
+if __name__ == "__main__":
+    unittest.main()